@@ -4,7 +4,7 @@ from data_pipeline.dataloaders import get_butterfly_dataloader, \
                                         get_sift_dataloader, \
                                         get_coloured_sift_dataloader
 import pandas as pd
-from data_pipeline.utils import read_images
+from data_pipeline.image_source import get_image_source
 from torch.utils.data import DataLoader
 from cnn_training import train_neural_net
 from PIL import Image
@@ -27,6 +27,15 @@ def get_argparser():
     parser.add_argument("-l", "--label-index", required=True, type=int, help="Which index to use as the label, between 1 and 5. Use 1 o classify species, 5 to classify families.")
     parser.add_argument("-c", "--colour-space", type=str, required=True, help="Which color space to use in SIFT features")
     parser.add_argument("-p", "--feature-folder", type=str, required=True, help="Path to folder for storing features to or loading them from.")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="Amount of processes used to extract SIFT descriptors.")
+    parser.add_argument("-chunk", "--chunk-size", default=16, type=int, help="Amount of images sent to a SIFT worker process at a time.")
+    parser.add_argument("-stream", "--streaming-batch-size", default=None, type=int, help="Train the vocabulary with streaming k-means on batches of this many descriptors.")
+    parser.add_argument("-sample", "--vocabulary-sample-size", default=None, type=int, help="Cluster the vocabulary from a random sample of this many descriptors.")
+    parser.add_argument("-seed", "--sample-seed", default=0, type=int, help="Seed used when sampling descriptors for the vocabulary.")
+    parser.add_argument("-norm", "--bow-normalisation", default="density", choices=["density", "l1", "none"], help="Normalisation of the BOW histograms.")
+    parser.add_argument("-tree", "--vocabulary-tree", default=None, type=int, nargs=2, metavar=("BRANCHING", "DEPTH"),
+                        help="Use a hierarchical k-means vocabulary tree with BRANCHING ** DEPTH words instead of the SIFT feature size.")
+    parser.add_argument("-prefetch", "--prefetch-images", default=0, type=int, help="Amount of threads decoding images ahead of feature extraction.")
     return parser
 
 if __name__ == '__main__':
@@ -36,5 +45,9 @@ if __name__ == '__main__':
     N = args.no_images if args.no_images < len(training_indices) else len(training_indices)
     label_i = args.label_index
     training_labels = training_indices.iloc[:, label_i]
-    training_images = read_images(args.image_root, training_indices, N, grey=False)
-    dataloader = get_coloured_sift_dataloader(training_images[:N], training_labels[:N], args.feature_folder, 32, args.colour_space, feature_size=args.sift_feature_size)
+    training_images = get_image_source(args.image_root, training_indices, N, grey=False, prefetch=args.prefetch_images)
+    sift_options = dict(workers=args.workers, chunk_size=args.chunk_size, streaming_batch_size=args.streaming_batch_size,
+                        vocabulary_sample_size=args.vocabulary_sample_size, sample_seed=args.sample_seed,
+                        normalisation=args.bow_normalisation if args.bow_normalisation != 'none' else None,
+                        vocabulary_tree=args.vocabulary_tree)
+    dataloader = get_coloured_sift_dataloader(training_images[:N], training_labels[:N], args.feature_folder, 32, args.colour_space, feature_size=args.sift_feature_size, **sift_options)
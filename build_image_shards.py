@@ -0,0 +1,30 @@
+import os
+import argparse
+from os import path
+from data_pipeline.image_shards import build_image_shard, get_shard_path
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='Decode and resize the images of dataset splits once into memory mapped shards')
+    parser.add_argument("-root", "--image-root", type=str, default="data/images_small",
+                        help="The path to the image data folder")
+    parser.add_argument("-idx", "--index-files", type=str, nargs='+',
+                        default=["data/Butterfly200_train_release.txt", "data/Butterfly200_val_release.txt"],
+                        help="The index files of the splits to build shards for")
+    parser.add_argument("-shards", "--shard-folder", type=str, default="data/shards", help="Folder to write the shards to.")
+    parser.add_argument("-color", "--color-space", type=str, default=None, help="Color space of the shard, none keeps the original BGR images.")
+    parser.add_argument("-g", "--grey", default=False, action="store_true", help="Build a grey shard.")
+    parser.add_argument("-size", "--image-size", type=int, default=256, help="Width and height the images are resized to.")
+    parser.add_argument("-prefetch", "--prefetch-images", default=4, type=int, help="Amount of threads decoding images ahead.")
+    parser.add_argument("-f", "--force", default=False, action="store_true", help="Rebuild shards that already exist.")
+    return parser
+
+if __name__ == '__main__':
+    parser = get_argparser()
+    args = parser.parse_args()
+    os.makedirs(args.shard_folder, exist_ok=True)
+    for index_file in args.index_files:
+        shard_path = get_shard_path(args.shard_folder, index_file, args.color_space, args.grey, args.image_size)
+        if path.exists(shard_path) and not args.force:
+            print('Shard', shard_path, 'already exists')
+            continue
+        build_image_shard(args.image_root, index_file, shard_path, args.color_space, args.grey, args.image_size, args.prefetch_images)
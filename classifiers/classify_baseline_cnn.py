@@ -1,14 +1,16 @@
 import sys
 sys.path.append('./')
 
+import time
 import argparse
 import pandas as pd
 
 from data_pipeline.dataloaders import get_baseline_cnn_dataloader
-from data_pipeline.utils import read_images, get_all_data_from_loader
+from data_pipeline.utils import get_dataset_arrays
+from data_pipeline.image_source import get_image_source
 from utils import get_indices_and_labels
 from training.cnn_training import evaluate_model_accuracy
-from svm_classifier import classify
+from svm_classifier import classify, sweep_classify, add_sweep_arguments, compare_approximations, add_approximation_arguments
 
 def get_argparser():
     parser = argparse.ArgumentParser(description='Obtain SIFT features for training set')
@@ -26,11 +28,56 @@ def get_argparser():
     parser.add_argument("-cnn-feat", "--cnn-features", required=True, type=str, help="Path to baseline CNN features")
     parser.add_argument("-cnn-test-feat", "--cnn-test-features", required=True, type=str, help="Path to baseline CNN features")
     parser.add_argument("-kernel", "--svm-kernel", default="linear", help="SVM kernel to use in classification")
+    parser.add_argument("-backend", "--classifier-backend", default="svc", choices=["svc", "liblinear", "sgd"],
+                        help="libsvm, a primal liblinear solver or SGD on chunks of the features, the latter two only for the linear kernel.")
     parser.add_argument("-g", "--grey", default=False, action="store_true")
     parser.add_argument("-c", "--color-space", type=str, default=None, help="Color space to use in baseline CNN features")
-    # TODO: add reduced dims
+    parser.add_argument("-ebs", "--extraction-batch-size", default=32, type=int, help="Amount of images in a forward pass of the feature extractor.")
+    parser.add_argument("-ew", "--extraction-workers", default=0, type=int, help="Amount of DataLoader processes preprocessing images for the feature extractor.")
+    parser.add_argument("-fast", "--fast-preprocess", default=False, action="store_true", help="Resize images with opencv instead of skimage.")
+    parser.add_argument("-interp", "--interpolation", default="auto", choices=["auto", "nearest", "linear", "cubic", "area"], help="Interpolation of the fast resize.")
+    parser.add_argument("-cl", "--channels-last", default=False, action="store_true", help="Run the feature extractor on channels last batches.")
+    parser.add_argument("-export", "--exported-extractor", default=False, action="store_true", help="Extract features with the frozen TorchScript export of the extractor.")
+    parser.add_argument("-int8", "--quantized", default=False, action="store_true", help="Extract features with int8 Linear layers.")
+    parser.add_argument("-int8-report", "--quantization-report", default=False, action="store_true",
+                        help="Compare the SVM accuracy on features of the float32 and the int8 extractor.")
+    parser.add_argument("-prefetch", "--prefetch-images", default=0, type=int, help="Amount of threads decoding images ahead of feature extraction.")
+    add_sweep_arguments(parser)
+    add_approximation_arguments(parser)
+    parser.add_argument("-dims", "--reduced-dims", default=None, type=int, help="Reduce the features to this many dimensions with a PCA fitted on the training features.")
+    parser.add_argument("-pca", "--projection-solver", default="randomized", choices=["randomized", "incremental"],
+                        help="Fit the PCA with a randomized SVD of all training features or incrementally on batches of them.")
     return parser
 
+def get_feature_dataloaders(args, training_images, training_labels, test_images, test_labels, label_amount, quantized=False):
+    baseline_cnn_feature_dataloader = get_baseline_cnn_dataloader(training_images, training_labels, label_amount, \
+                                                                        32, args.cnn_features, args.baseline_cnn_path, args.color_space, args.grey,
+                                                                        extraction_batch_size=args.extraction_batch_size, extraction_workers=args.extraction_workers,
+                                                                        fast_preprocess=args.fast_preprocess, interpolation=args.interpolation, channels_last=args.channels_last,
+                                                                        exported=args.exported_extractor, quantized=quantized,
+                                                                        reduced_dims=args.reduced_dims, projection_solver=args.projection_solver)
+    test_baseline_cnn_feature_dataloader = get_baseline_cnn_dataloader(test_images, test_labels, label_amount, \
+                                                                        32, args.cnn_test_features, args.baseline_cnn_path, args.color_space, args.grey,
+                                                                        extraction_batch_size=args.extraction_batch_size, extraction_workers=args.extraction_workers,
+                                                                        fast_preprocess=args.fast_preprocess, interpolation=args.interpolation, channels_last=args.channels_last,
+                                                                        exported=args.exported_extractor, quantized=quantized,
+                                                                        reduced_dims=args.reduced_dims, projection_solver=args.projection_solver,
+                                                                        projection_path=baseline_cnn_feature_dataloader.dataset.projection_path)
+    return baseline_cnn_feature_dataloader, test_baseline_cnn_feature_dataloader
+
+def report_quantization_accuracy(args, training_images, training_labels, test_images, test_labels, label_amount):
+    """Print the SVM test accuracy on features of the float32 and the int8 extractor."""
+    accuracies = []
+    for quantized in [False, True]:
+        start = time.time()
+        dataloaders = get_feature_dataloaders(args, training_images, training_labels, test_images, test_labels, label_amount, quantized)
+        feature_time = time.time() - start
+        classifier = classify(*dataloaders, args.svm_kernel, backend=args.classifier_backend)
+        test_features, test_targets = get_dataset_arrays(dataloaders[1])
+        accuracies.append(classifier.score(test_features, test_targets))
+        print('int8' if quantized else 'float32', 'features in', feature_time, 's, SVM test accuracy', accuracies[-1])
+    print('Accuracy of int8 features differs from float32 by', accuracies[1] - accuracies[0])
+
 if __name__ == "__main__":
     parser = get_argparser()
     args = parser.parse_args()
@@ -38,11 +85,22 @@ if __name__ == "__main__":
     test_N = 1000
     label_i = args.label_index
     training_indices, training_labels = get_indices_and_labels(args.training_index_file, args.label_index)
-    training_images = read_images(args.image_root, training_indices, N, grey=False)
+    training_images = get_image_source(args.image_root, training_indices, N, grey=False, prefetch=args.prefetch_images)
     test_indices, test_labels = get_indices_and_labels(args.test_index_file, args.label_index)
-    test_images = read_images(args.image_root, test_indices, test_N, grey=False)
-    baseline_cnn_feature_dataloader = get_baseline_cnn_dataloader(training_images, training_labels[:N], training_labels.nunique(), \
-                                                                        32, args.cnn_features, args.baseline_cnn_path, args.color_space, args.grey)
-    test_baseline_cnn_feature_dataloader = get_baseline_cnn_dataloader(test_images, test_labels[:test_N], training_labels.nunique(), \
-                                                                        32, args.cnn_test_features, args.baseline_cnn_path, args.color_space, args.grey)
-    classifier = classify(baseline_cnn_feature_dataloader, test_baseline_cnn_feature_dataloader, args.svm_kernel)
+    test_images = get_image_source(args.image_root, test_indices, test_N, grey=False, prefetch=args.prefetch_images)
+    if args.quantization_report:
+        report_quantization_accuracy(args, training_images, training_labels[:N], test_images, test_labels[:test_N], training_labels.nunique())
+    else:
+        baseline_cnn_feature_dataloader, test_baseline_cnn_feature_dataloader = get_feature_dataloaders(args, training_images, training_labels[:N], test_images,
+                                                                                                        test_labels[:test_N], training_labels.nunique(),
+                                                                                                        args.quantized)
+        if args.sweep_kernels is not None:
+            sweep_classify(baseline_cnn_feature_dataloader, test_baseline_cnn_feature_dataloader, args.sweep_kernels, args.sweep_c, args.gram_folder, args.cv_folds, args.sweep_processes)
+            sys.exit()
+        if args.approximation_compare_ranks is not None:
+            backend = args.classifier_backend if args.classifier_backend != 'svc' else 'liblinear'
+            compare_approximations(baseline_cnn_feature_dataloader, test_baseline_cnn_feature_dataloader, args.svm_kernel, args.kernel_approximation or 'nystroem',
+                                   args.approximation_compare_ranks, backend)
+            sys.exit()
+        classifier = classify(baseline_cnn_feature_dataloader, test_baseline_cnn_feature_dataloader, args.svm_kernel, backend=args.classifier_backend,
+                              approximation=args.kernel_approximation, rank=args.approximation_rank)
@@ -8,7 +8,7 @@ import pandas as pd
 from data_pipeline.dataloaders import get_combined_sift_dataloader
 from data_pipeline.utils import read_images
 from classifiers.utils import get_indices_and_labels
-from classifiers.svm_classifier import classify
+from classifiers.svm_classifier import classify, sweep_classify, add_sweep_arguments, compare_approximations, add_approximation_arguments
 
 def get_argparser():
     parser = argparse.ArgumentParser(description='Obtain SIFT features for training set')
@@ -24,9 +24,16 @@ def get_argparser():
     parser.add_argument("-f", "--feature-folder", required=True, type=str, help="The path to SIFT feature base filename")
     parser.add_argument("-N", "--no-images", required=True, type=int, help="The amount of images to use in building features")
     parser.add_argument("-l", "--label-index", required=True, type=int, help="Which index to use as the label, between 1 and 5. Use 1 o classify species, 5 to classify families.")
-    parser.add_argument("-kernel", "--svm-kernel", default="linear", help="SVM kernel to use in classification")
+    parser.add_argument("-kernel", "--svm-kernel", default="linear",
+                        help="SVM kernel to use in classification, intersection, additive_chi2 and chi2 compare the BoW histograms bin by bin")
+    parser.add_argument("-backend", "--classifier-backend", default="svc", choices=["svc", "liblinear", "sgd"],
+                        help="libsvm, a primal liblinear solver or SGD on chunks of the features, the latter two only for the linear kernel.")
     parser.add_argument("-g", "--grey", default=False, action="store_true")
-    # TODO: add reduced dims
+    add_sweep_arguments(parser)
+    add_approximation_arguments(parser)
+    parser.add_argument("-dims", "--reduced-dims", default=None, type=int, help="Reduce the features to this many dimensions with a PCA fitted on the training features.")
+    parser.add_argument("-pca", "--projection-solver", default="randomized", choices=["randomized", "incremental"],
+                        help="Fit the PCA with a randomized SVD of all training features or incrementally on batches of them.")
     return parser
 
 if __name__ == "__main__":
@@ -41,6 +48,17 @@ if __name__ == "__main__":
     test_images = read_images(args.image_root, test_indices, test_N, grey=False)
     sift_dataloader = None
     test_sift_dataloader = None
-    sift_dataloader = get_combined_sift_dataloader(training_labels[:N], 32, args.feature_folder, args.sift_feature_size, grey=args.grey)
-    test_sift_dataloader = get_combined_sift_dataloader(test_labels[:test_N], 32, args.feature_folder, args.sift_feature_size, grey=args.grey, test=True)
-    classifier = classify(sift_dataloader, test_sift_dataloader, args.svm_kernel)
+    sift_dataloader = get_combined_sift_dataloader(training_labels[:N], 32, args.feature_folder, args.sift_feature_size, grey=args.grey, reduced_dims=args.reduced_dims,
+                                                   projection_solver=args.projection_solver)
+    test_sift_dataloader = get_combined_sift_dataloader(test_labels[:test_N], 32, args.feature_folder, args.sift_feature_size, grey=args.grey, test=True, reduced_dims=args.reduced_dims,
+                                                        projection_solver=args.projection_solver)
+    if args.sweep_kernels is not None:
+        sweep_classify(sift_dataloader, test_sift_dataloader, args.sweep_kernels, args.sweep_c, args.gram_folder, args.cv_folds, args.sweep_processes)
+        sys.exit()
+    if args.approximation_compare_ranks is not None:
+        backend = args.classifier_backend if args.classifier_backend != 'svc' else 'liblinear'
+        compare_approximations(sift_dataloader, test_sift_dataloader, args.svm_kernel, args.kernel_approximation or 'nystroem',
+                               args.approximation_compare_ranks, backend)
+        sys.exit()
+    classifier = classify(sift_dataloader, test_sift_dataloader, args.svm_kernel, backend=args.classifier_backend,
+                          approximation=args.kernel_approximation, rank=args.approximation_rank)
@@ -7,9 +7,9 @@ import numpy as np
 import cv2 as cv
 
 from data_pipeline.dataloaders import get_sift_dataloader, get_coloured_sift_dataloader
-from data_pipeline.utils import read_images
+from data_pipeline.image_source import get_image_source
 from classifiers.utils import get_indices_and_labels
-from classifiers.svm_classifier import classify
+from classifiers.svm_classifier import classify, sweep_classify, add_sweep_arguments, compare_approximations, add_approximation_arguments
 
 def get_argparser():
     parser = argparse.ArgumentParser(description='Obtain SIFT features for training set')
@@ -26,7 +26,21 @@ def get_argparser():
     parser.add_argument("-c", "--colour-space", type=str, default=None, help="The colour space to use. None for unnormalised RGB.")
     parser.add_argument("-N", "--no-images", required=True, type=int, help="The amount of images to use in building features")
     parser.add_argument("-l", "--label-index", required=True, type=int, help="Which index to use as the label, between 1 and 5. Use 1 o classify species, 5 to classify families.")
-    parser.add_argument("-kernel", "--svm-kernel", default="linear", help="SVM kernel to use in classification")
+    parser.add_argument("-kernel", "--svm-kernel", default="linear",
+                        help="SVM kernel to use in classification, intersection, additive_chi2 and chi2 compare the BoW histograms bin by bin")
+    parser.add_argument("-backend", "--classifier-backend", default="svc", choices=["svc", "liblinear", "sgd"],
+                        help="libsvm, a primal liblinear solver or SGD on chunks of the features, the latter two only for the linear kernel.")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="Amount of processes used to extract SIFT descriptors.")
+    parser.add_argument("-chunk", "--chunk-size", default=16, type=int, help="Amount of images sent to a SIFT worker process at a time.")
+    parser.add_argument("-stream", "--streaming-batch-size", default=None, type=int, help="Train the vocabulary with streaming k-means on batches of this many descriptors.")
+    parser.add_argument("-sample", "--vocabulary-sample-size", default=None, type=int, help="Cluster the vocabulary from a random sample of this many descriptors.")
+    parser.add_argument("-seed", "--sample-seed", default=0, type=int, help="Seed used when sampling descriptors for the vocabulary.")
+    parser.add_argument("-norm", "--bow-normalisation", default="density", choices=["density", "l1", "none"], help="Normalisation of the BOW histograms.")
+    parser.add_argument("-tree", "--vocabulary-tree", default=None, type=int, nargs=2, metavar=("BRANCHING", "DEPTH"),
+                        help="Use a hierarchical k-means vocabulary tree with BRANCHING ** DEPTH words instead of the SIFT feature size.")
+    parser.add_argument("-prefetch", "--prefetch-images", default=0, type=int, help="Amount of threads decoding images ahead of feature extraction.")
+    add_sweep_arguments(parser)
+    add_approximation_arguments(parser)
     # TODO: add reduced dims
     return parser
 
@@ -37,21 +51,34 @@ if __name__ == "__main__":
     test_N = 1000
     label_i = args.label_index
     training_indices, training_labels = get_indices_and_labels(args.training_index_file, args.label_index)
-    training_images = read_images(args.image_root, training_indices, N, grey=False)
+    training_images = get_image_source(args.image_root, training_indices, N, grey=False, prefetch=args.prefetch_images)
     test_indices, test_labels = get_indices_and_labels(args.test_index_file, args.label_index)
-    test_images = read_images(args.image_root, test_indices, test_N, grey=False)
+    test_images = get_image_source(args.image_root, test_indices, test_N, grey=False, prefetch=args.prefetch_images)
     sift_dataloader = None
     test_sift_dataloader = None
+    sift_options = dict(workers=args.workers, chunk_size=args.chunk_size, streaming_batch_size=args.streaming_batch_size,
+                        vocabulary_sample_size=args.vocabulary_sample_size, sample_seed=args.sample_seed,
+                        normalisation=args.bow_normalisation if args.bow_normalisation != 'none' else None,
+                        vocabulary_tree=args.vocabulary_tree)
     if args.colour_space is None:
-        sift_dataloader = get_sift_dataloader(training_images, training_labels[:N], args.feature_folder, 32, feature_size=args.sift_feature_size)
-        test_sift_dataloader = get_sift_dataloader(test_images, test_labels[:test_N], args.feature_folder, 32, feature_size=args.sift_feature_size, test=True)
+        sift_dataloader = get_sift_dataloader(training_images, training_labels[:N], args.feature_folder, 32, feature_size=args.sift_feature_size, **sift_options)
+        test_sift_dataloader = get_sift_dataloader(test_images, test_labels[:test_N], args.feature_folder, 32, feature_size=args.sift_feature_size, test=True, **sift_options)
     else:
-        sift_dataloader = get_coloured_sift_dataloader(training_images, training_labels[:N], args.feature_folder, 32, args.colour_space, feature_size=args.sift_feature_size)
-        test_sift_dataloader = get_coloured_sift_dataloader(test_images, test_labels[:test_N], args.feature_folder, 32, args.colour_space, feature_size=args.sift_feature_size, test=True)
-    classifier = classify(sift_dataloader, test_sift_dataloader, args.svm_kernel)
+        sift_dataloader = get_coloured_sift_dataloader(training_images, training_labels[:N], args.feature_folder, 32, args.colour_space, feature_size=args.sift_feature_size, **sift_options)
+        test_sift_dataloader = get_coloured_sift_dataloader(test_images, test_labels[:test_N], args.feature_folder, 32, args.colour_space, feature_size=args.sift_feature_size, test=True, **sift_options)
+    if args.sweep_kernels is not None:
+        sweep_classify(sift_dataloader, test_sift_dataloader, args.sweep_kernels, args.sweep_c, args.gram_folder, args.cv_folds, args.sweep_processes)
+        sys.exit()
+    if args.approximation_compare_ranks is not None:
+        backend = args.classifier_backend if args.classifier_backend != 'svc' else 'liblinear'
+        compare_approximations(sift_dataloader, test_sift_dataloader, args.svm_kernel, args.kernel_approximation or 'nystroem',
+                               args.approximation_compare_ranks, backend)
+        sys.exit()
+    classifier = classify(sift_dataloader, test_sift_dataloader, args.svm_kernel, backend=args.classifier_backend,
+                          approximation=args.kernel_approximation, rank=args.approximation_rank)
     preds = classifier.predict(test_sift_features)
     false_pred = preds != test_sift_labels
-    false_pred_images = np.asarray(test_images)[false_pred]
+    false_pred_images = [test_images[i] for i in np.flatnonzero(false_pred)]
     for i in range(5):
         cv.imshow('', false_pred_images[i])
         cv.waitKey(0)
@@ -7,9 +7,9 @@ import cv2 as cv
 import numpy as np
 
 from data_pipeline.dataloaders import get_pretrained_imagenet_dataloader
-from data_pipeline.utils import read_images
+from data_pipeline.image_source import get_image_source
 from classifiers.utils import get_indices_and_labels
-from classifiers.svm_classifier import classify
+from classifiers.svm_classifier import classify, sweep_classify, add_sweep_arguments, compare_approximations, add_approximation_arguments
 
 def get_argparser():
     parser = argparse.ArgumentParser(description='Obtain SIFT features for training set')
@@ -28,7 +28,20 @@ def get_argparser():
     parser.add_argument("-ex", "--imagenet-extractor-path", required=True, type=str, help="Path to model pretrained with Imagenet and trained with transfer learning")
     parser.add_argument("-imagenet", "--imagenet-features", required=True, type=str, help="Path to imagenet features")
     parser.add_argument("-kernel", "--svm-kernel", default="linear", help="SVM kernel to use in classification")
-    # TODO: add reduced dims
+    parser.add_argument("-backend", "--classifier-backend", default="svc", choices=["svc", "liblinear", "sgd"],
+                        help="libsvm, a primal liblinear solver or SGD on chunks of the features, the latter two only for the linear kernel.")
+    parser.add_argument("-ebs", "--extraction-batch-size", default=32, type=int, help="Amount of images in a forward pass of the feature extractor.")
+    parser.add_argument("-ew", "--extraction-workers", default=0, type=int, help="Amount of DataLoader processes preprocessing images for the feature extractor.")
+    parser.add_argument("-fast", "--fast-preprocess", default=False, action="store_true", help="Resize images with opencv instead of skimage.")
+    parser.add_argument("-interp", "--interpolation", default="auto", choices=["auto", "nearest", "linear", "cubic", "area"], help="Interpolation of the fast resize.")
+    parser.add_argument("-cl", "--channels-last", default=False, action="store_true", help="Run the feature extractor on channels last batches.")
+    parser.add_argument("-export", "--exported-extractor", default=False, action="store_true", help="Extract features with the frozen TorchScript export of the extractor.")
+    parser.add_argument("-prefetch", "--prefetch-images", default=0, type=int, help="Amount of threads decoding images ahead of feature extraction.")
+    add_sweep_arguments(parser)
+    add_approximation_arguments(parser)
+    parser.add_argument("-dims", "--reduced-dims", default=None, type=int, help="Reduce the features to this many dimensions with a PCA fitted on the training features.")
+    parser.add_argument("-pca", "--projection-solver", default="randomized", choices=["randomized", "incremental"],
+                        help="Fit the PCA with a randomized SVD of all training features or incrementally on batches of them.")
     return parser
 
 if __name__ == "__main__":
@@ -38,18 +51,36 @@ if __name__ == "__main__":
     test_N = 1000
     label_i = args.label_index
     training_indices, training_labels = get_indices_and_labels(args.training_index_file, args.label_index)
-    training_images = read_images(args.image_root, training_indices, N, grey=False)
+    training_images = get_image_source(args.image_root, training_indices, N, grey=False, prefetch=args.prefetch_images)
     test_indices, test_labels = get_indices_and_labels(args.test_index_file, args.label_index)
-    test_images = read_images(args.image_root, test_indices, test_N, grey=False)
+    test_images = get_image_source(args.image_root, test_indices, test_N, grey=False, prefetch=args.prefetch_images)
     imagenet_feature_dataloader = get_pretrained_imagenet_dataloader(training_images, training_labels[:N], training_labels.nunique(), \
-                                                                        32, args.imagenet_features, args.imagenet_extractor_path)
+                                                                        32, args.imagenet_features, args.imagenet_extractor_path,
+                                                                        extraction_batch_size=args.extraction_batch_size, extraction_workers=args.extraction_workers,
+                                                                        fast_preprocess=args.fast_preprocess, interpolation=args.interpolation, channels_last=args.channels_last,
+                                                                        exported=args.exported_extractor, reduced_dims=args.reduced_dims,
+                                                                        projection_solver=args.projection_solver)
     test_imagenet_feature_dataloader = get_pretrained_imagenet_dataloader(test_images, test_labels[:test_N], test_labels[:test_N].nunique(), \
-                                                                        32, args.imagenet_features + '_test', args.imagenet_extractor_path)
-    classifier = classify(imagenet_feature_dataloader, test_imagenet_feature_dataloader, args.svm_kernel)
+                                                                        32, args.imagenet_features + '_test', args.imagenet_extractor_path,
+                                                                        extraction_batch_size=args.extraction_batch_size, extraction_workers=args.extraction_workers,
+                                                                        fast_preprocess=args.fast_preprocess, interpolation=args.interpolation, channels_last=args.channels_last,
+                                                                        exported=args.exported_extractor, reduced_dims=args.reduced_dims,
+                                                                        projection_solver=args.projection_solver,
+                                                                        projection_path=imagenet_feature_dataloader.dataset.projection_path)
+    if args.sweep_kernels is not None:
+        sweep_classify(imagenet_feature_dataloader, test_imagenet_feature_dataloader, args.sweep_kernels, args.sweep_c, args.gram_folder, args.cv_folds, args.sweep_processes)
+        sys.exit()
+    if args.approximation_compare_ranks is not None:
+        backend = args.classifier_backend if args.classifier_backend != 'svc' else 'liblinear'
+        compare_approximations(imagenet_feature_dataloader, test_imagenet_feature_dataloader, args.svm_kernel, args.kernel_approximation or 'nystroem',
+                               args.approximation_compare_ranks, backend)
+        sys.exit()
+    classifier = classify(imagenet_feature_dataloader, test_imagenet_feature_dataloader, args.svm_kernel, backend=args.classifier_backend,
+                          approximation=args.kernel_approximation, rank=args.approximation_rank)
     # show false predictions
     preds = classifier.predict(test_imagenet_features)
     false_pred = preds != test_imagenet_labels
-    false_pred_images = np.asarray(test_images)[false_pred]
+    false_pred_images = [test_images[i] for i in np.flatnonzero(false_pred)]
     for i in range(5):
         cv.imshow('', false_pred_images[i])
         cv.waitKey(0)
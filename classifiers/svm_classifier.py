@@ -1,20 +1,293 @@
 import sys
 sys.path.append('./')
 
-from sklearn.svm import SVC
-from sklearn.model_selection import cross_val_score
+import os
+import time
+import hashlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.svm import SVC, LinearSVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.kernel_approximation import Nystroem, AdditiveChi2Sampler
+from sklearn.metrics.pairwise import pairwise_kernels
+from sklearn.model_selection import cross_val_score, StratifiedKFold
 
-from data_pipeline.utils import get_all_data_from_loader
+from data_pipeline.utils import get_dataset_arrays
+from data_pipeline.feature_cache import hash_parts
+from data_pipeline.feature_store import FeatureWriter, load_features
+from classifiers.histogram_kernels import HISTOGRAM_KERNELS, histogram_kernel, get_chi2_gamma
 
-def classify(training_dataloader, test_dataloader, kernel, cv=False):
-    training_features, training_labels = get_all_data_from_loader(training_dataloader)
-    test_features, test_labels = get_all_data_from_loader(test_dataloader)
+# svc is libsvm with any kernel, liblinear solves the linear SVM in the primal,
+# sgd trains a linear SVM with stochastic gradient descent on chunks of the features
+BACKENDS = ['svc', 'liblinear', 'sgd']
+# explicit feature maps approximating a kernel, a linear backend trained on the mapped features approximates the kernel SVM
+APPROXIMATIONS = ['nystroem', 'additive_chi2']
+
+def get_classifier(backend, kernel):
+    if backend == 'svc':
+        # the histogram kernels are given to the SVC as precomputed Gram matrices
+        return SVC(kernel='precomputed' if kernel in HISTOGRAM_KERNELS else kernel)
+    if kernel != 'linear':
+        raise ValueError('The ' + backend + ' backend only trains linear classifiers, use the svc backend for the ' + kernel + ' kernel')
+    if backend == 'liblinear':
+        # the primal problem is solved, which scales with the amount of samples times the feature size
+        return LinearSVC(dual=False)
+    if backend == 'sgd':
+        return SGDClassifier(loss='hinge', alpha=1e-4, random_state=0)
+    raise ValueError('Please give a supported backend, one of ' + ', '.join(BACKENDS))
+
+def fit_in_chunks(classifier, features, labels, chunk_size=4096, epochs=5):
+    """Fit an SGDClassifier with partial_fit on chunks of the features, only a chunk is in memory at a time.
+
+    The rows are shuffled every epoch, the rows of a chunk are read in order so memory mapped features are read sequentially.
+    """
+    classes = np.unique(labels)
+    random_state = np.random.RandomState(0)
+    for _ in range(epochs):
+        order = random_state.permutation(len(features))
+        for start in range(0, len(features), chunk_size):
+            rows = np.sort(order[start:start + chunk_size])
+            classifier.partial_fit(features[rows], labels[rows], classes=classes)
+    return classifier
+
+def get_feature_map(approximation, kernel, training_features, rank=1000):
+    """Fit an explicit feature map approximating the kernel on the training features.
+
+    Args:
+        approximation (string): nystroem samples rank training features as the basis of the map, for the rbf, poly, sigmoid
+            and chi2 kernels. additive_chi2 samples the Fourier transform of the additive chi2 kernel of the histograms.
+        rank (int): Amount of Nystroem basis features, the size of the mapped features.
+    """
+    if approximation == 'nystroem':
+        if kernel not in ['rbf', 'poly', 'sigmoid', 'chi2']:
+            raise ValueError('The Nystroem approximation supports the rbf, poly, sigmoid and chi2 kernels, not ' + kernel)
+        feature_map = Nystroem(kernel=kernel, gamma=get_gamma(training_features, kernel),
+                               n_components=min(rank, len(training_features)), random_state=0)
+    elif approximation == 'additive_chi2':
+        if kernel != 'additive_chi2':
+            raise ValueError('The additive_chi2 approximation only approximates the additive_chi2 kernel, not ' + kernel)
+        feature_map = AdditiveChi2Sampler(sample_steps=2)
+    else:
+        raise ValueError('Please give a supported approximation, one of ' + ', '.join(APPROXIMATIONS))
+    return feature_map.fit(training_features)
+
+def map_features(feature_map, features, chunk_size=4096):
+    # chunk by chunk, so only a chunk of the float64 intermediates is in memory
+    mapped = [feature_map.transform(np.asarray(features[start:start + chunk_size])).astype(np.float32)
+              for start in range(0, len(features), chunk_size)]
+    return np.concatenate(mapped)
+
+def classify(training_dataloader, test_dataloader, kernel, cv=False, backend='svc', chunk_size=4096, epochs=5,
+             approximation=None, rank=1000):
+    """Train a classifier on the training features and print its fit time, predict time and test accuracy.
+
+    With one of the HISTOGRAM_KERNELS the SVC is trained on the precomputed Gram matrix of the training features,
+    the returned classifier then predicts from the Gram matrix between samples and the training features.
+    With an approximation a linear classifier is trained on the mapped features, the returned classifier is a
+    pipeline of the feature map fitted on the training features and the linear classifier, so it predicts from features.
+
+    Args:
+        kernel (string): SVM kernel or one of HISTOGRAM_KERNELS, the liblinear and sgd backends only support linear.
+        backend (string): One of BACKENDS, the liblinear or sgd backend with an approximation.
+        chunk_size (int): Amount of samples in a partial_fit of the sgd backend.
+        epochs (int): Amount of passes over the training features of the sgd backend.
+        approximation (string): One of APPROXIMATIONS to approximate the kernel with, None for the exact kernel.
+        rank (int): Size of the Nystroem feature map.
+    """
+    # the feature matrices of the datasets, rather than rebuilding them batch by batch from the dataloaders
+    training_features, training_labels = get_dataset_arrays(training_dataloader)
+    test_features, test_labels = get_dataset_arrays(test_dataloader)
     print('Got features')
-    classifier = SVC(kernel=kernel)
+    return fit_and_score(training_features, training_labels, test_features, test_labels, kernel, cv, backend, chunk_size,
+                         epochs, approximation, rank)[0]
+
+def fit_and_score(training_features, training_labels, test_features, test_labels, kernel, cv=False, backend='svc',
+                  chunk_size=4096, epochs=5, approximation=None, rank=1000):
+    """See classify, returns the classifier, its fit time including the feature map or Gram matrix, and its test accuracy."""
+    start = time.time()
+    feature_map = None
+    if approximation is not None:
+        if backend == 'svc':
+            raise ValueError('Please train the approximated kernel with the liblinear or sgd backend')
+        feature_map = get_feature_map(approximation, kernel, training_features, rank)
+        training_features = map_features(feature_map, training_features, chunk_size)
+        print('Mapped training features with', approximation, 'to', training_features.shape[1], 'dimensions in', time.time() - start, 's')
+        classifier = get_classifier(backend, 'linear')
+    else:
+        classifier = get_classifier(backend, kernel)
+    precomputed = kernel in HISTOGRAM_KERNELS and approximation is None
+    if precomputed:
+        gamma = get_gamma(training_features, kernel)
+        histograms = training_features
+        training_features = histogram_kernel(kernel, histograms, histograms, gamma)
+        print('Computed', kernel, 'Gram matrix in', time.time() - start, 's')
+    # the time of the feature map or the Gram matrix counts towards the fit time
+    preparation_time = time.time() - start
     if cv:
         cv_scores = cross_val_score(classifier, training_features, training_labels, cv=3)
         print('CV score  mean', cv_scores.mean())
-    classifier.fit(training_features, training_labels)
-    test_scores = classifier.score(test_features, test_labels)
+    start = time.time()
+    if backend == 'sgd':
+        fit_in_chunks(classifier, training_features, training_labels, chunk_size, epochs)
+    else:
+        classifier.fit(training_features, training_labels)
+    fit_time = preparation_time + time.time() - start
+    if feature_map is not None:
+        classifier = make_pipeline(feature_map, classifier)
+    start = time.time()
+    if precomputed:
+        test_features = histogram_kernel(kernel, test_features, histograms, gamma)
+    predictions = classifier.predict(test_features)
+    predict_time = time.time() - start
+    test_scores = np.mean(predictions == test_labels)
+    print('Backend', backend, 'fit in', fit_time, 's, predicted in', predict_time, 's')
     print('Test set scores', test_scores)
-    return classifier
+    return classifier, fit_time, test_scores
+
+def compare_approximations(training_dataloader, test_dataloader, kernel, approximation, ranks, backend='liblinear'):
+    """Train the exact SVC and the approximation at every rank, and print their fit times and test accuracies.
+
+    Args:
+        ranks (list): Nystroem ranks, only the first one is used by the additive_chi2 approximation as it has no rank.
+
+    Returns:
+        DataFrame: A row per classifier with its fit time, including the feature map or Gram matrix, and test accuracy.
+    """
+    training_features, training_labels = get_dataset_arrays(training_dataloader)
+    test_features, test_labels = get_dataset_arrays(test_dataloader)
+    arrays = (training_features, training_labels, test_features, test_labels)
+    results = []
+    _, fit_time, test_accuracy = fit_and_score(*arrays, kernel)
+    results.append({'classifier': 'exact svc', 'rank': np.nan, 'fit_seconds': fit_time, 'test_accuracy': test_accuracy})
+    for rank in ranks if approximation == 'nystroem' else ranks[:1]:
+        _, fit_time, test_accuracy = fit_and_score(*arrays, kernel, backend=backend, approximation=approximation, rank=rank)
+        results.append({'classifier': approximation + ' ' + backend, 'rank': rank if approximation == 'nystroem' else np.nan,
+                        'fit_seconds': fit_time, 'test_accuracy': test_accuracy})
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results
+
+def get_gamma(features, kernel='rbf'):
+    # computed once, so every block of a Gram matrix uses the same one
+    if kernel == 'chi2':
+        return get_chi2_gamma(features)
+    # the gamma SVC uses for gamma='scale'
+    return 1.0 / (features.shape[1] * features.var())
+
+def get_kernel_block(kernel, features_a, features_b, gamma):
+    """The kernel values between two blocks of features, as float32."""
+    if kernel == 'linear':
+        return np.dot(features_a, features_b.T).astype(np.float32)
+    if kernel in HISTOGRAM_KERNELS:
+        return histogram_kernel(kernel, features_a, features_b, gamma)
+    return pairwise_kernels(features_a, features_b, metric=kernel, gamma=gamma).astype(np.float32)
+
+def features_checksum(features):
+    sha = hashlib.sha1()
+    for start in range(0, len(features), 4096):
+        sha.update(np.ascontiguousarray(features[start:start + 4096]).tobytes())
+    return sha.hexdigest()
+
+def compute_gram_matrix(kernel, features_a, features_b, gram_path, gamma, block_size=1024):
+    """Compute the (len(features_a), len(features_b)) Gram matrix block by block into a memory mapped feature file.
+
+    Only a block of rows is in memory at a time, the file is renamed into place once it is complete.
+    """
+    if os.path.exists(gram_path):
+        print('Found Gram matrix', gram_path)
+        return load_features(gram_path)
+    start = time.time()
+    tmp_path = gram_path + '.tmp'
+    writer = FeatureWriter(tmp_path, (len(features_a), len(features_b)), dtype=np.float32)
+    for row in range(0, len(features_a), block_size):
+        writer[row:row + block_size] = get_kernel_block(kernel, np.asarray(features_a[row:row + block_size]), features_b, gamma)
+    writer.close()
+    os.replace(tmp_path, gram_path)
+    print('Computed', kernel, 'Gram matrix of shape', (len(features_a), len(features_b)), 'in', time.time() - start, 's')
+    return load_features(gram_path)
+
+def score_fold(job):
+    # runs in a worker process, the Gram matrix is opened by path so every worker shares its pages
+    gram_path, labels, train_idx, eval_idx, C = job
+    gram = load_features(gram_path)
+    start = time.time()
+    classifier = SVC(kernel='precomputed', C=C)
+    classifier.fit(gram[np.ix_(train_idx, train_idx)].astype(np.float64), labels[train_idx])
+    score = classifier.score(gram[np.ix_(eval_idx, train_idx)].astype(np.float64), labels[eval_idx])
+    return score, time.time() - start
+
+def sweep(training_features, training_labels, test_features, test_labels, kernels, Cs, gram_folder, folds=3, processes=None):
+    """Cross validate every kernel and C on precomputed Gram matrices and test the best C of every kernel.
+
+    The Gram matrix of a kernel is computed once and shared by all its C values and folds, which run in parallel processes.
+
+    Args:
+        kernels (list): Kernel names, see get_kernel_block.
+        Cs (list): SVM regularisation values.
+        gram_folder (string): Folder for the Gram matrices, they are reused by later sweeps on the same features.
+        folds (int): Amount of stratified cross validation folds.
+        processes (int): Amount of processes fitting folds, all cores by default.
+
+    Returns:
+        DataFrame: A row per kernel and C with the CV accuracy, the mean fit time of a fold and the test accuracy of the best C.
+    """
+    os.makedirs(gram_folder, exist_ok=True)
+    training_features = np.asarray(training_features)
+    training_labels = np.asarray(training_labels)
+    test_labels = np.asarray(test_labels)
+    features_key = [features_checksum(training_features), features_checksum(test_features)]
+    splits = list(StratifiedKFold(folds, shuffle=True, random_state=0).split(np.zeros(len(training_labels)), training_labels))
+    results = []
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        for kernel in kernels:
+            gamma = get_gamma(training_features, kernel)
+            key = hash_parts(features_key, gamma)[:16]
+            train_gram_path = os.path.join(gram_folder, 'gram_' + kernel + '_train_' + key)
+            test_gram_path = os.path.join(gram_folder, 'gram_' + kernel + '_test_' + key)
+            compute_gram_matrix(kernel, training_features, training_features, train_gram_path, gamma)
+            test_gram = compute_gram_matrix(kernel, test_features, training_features, test_gram_path, gamma)
+            jobs = [(train_gram_path, training_labels, train_idx, eval_idx, C) for C in Cs for train_idx, eval_idx in splits]
+            start = time.time()
+            fold_results = pool.map(score_fold, jobs)
+            print('Cross validated', len(Cs), 'C values of the', kernel, 'kernel in', time.time() - start, 's')
+            kernel_results = []
+            for i, C in enumerate(Cs):
+                scores, fit_times = zip(*fold_results[i * folds:(i + 1) * folds])
+                kernel_results.append({'kernel': kernel, 'C': C, 'cv_mean': np.mean(scores), 'cv_std': np.std(scores),
+                                       'fold_seconds': np.mean(fit_times), 'test_accuracy': np.nan})
+            best = max(kernel_results, key=lambda result: result['cv_mean'])
+            classifier = SVC(kernel='precomputed', C=best['C'])
+            classifier.fit(np.asarray(load_features(train_gram_path), dtype=np.float64), training_labels)
+            best['test_accuracy'] = classifier.score(np.asarray(test_gram, dtype=np.float64), test_labels)
+            results += kernel_results
+    finally:
+        pool.close()
+        pool.join()
+    return pd.DataFrame(results)
+
+def sweep_classify(training_dataloader, test_dataloader, kernels, Cs, gram_folder, folds=3, processes=None):
+    """Run a sweep on the features of two dataloaders, print the results table and save it as sweep_results.csv in gram_folder."""
+    training_features, training_labels = get_dataset_arrays(training_dataloader)
+    test_features, test_labels = get_dataset_arrays(test_dataloader)
+    results = sweep(training_features, training_labels, test_features, test_labels, kernels, Cs, gram_folder, folds, processes)
+    print(results.to_string(index=False))
+    results.to_csv(os.path.join(gram_folder, 'sweep_results.csv'), index=False)
+    return results
+
+def add_sweep_arguments(parser):
+    parser.add_argument("-sweep", "--sweep-kernels", nargs='+', default=None,
+                        help="Cross validate these kernels and the C values on precomputed Gram matrices instead of training one classifier.")
+    parser.add_argument("-C", "--sweep-c", nargs='+', type=float, default=[0.1, 1.0, 10.0], help="C values of the sweep.")
+    parser.add_argument("-folds", "--cv-folds", type=int, default=3, help="Amount of cross validation folds of the sweep.")
+    parser.add_argument("-sweep-procs", "--sweep-processes", type=int, default=None, help="Amount of processes fitting folds, all cores by default.")
+    parser.add_argument("-gram", "--gram-folder", type=str, default="data/gram_matrices", help="Folder for the Gram matrices and results of the sweep.")
+
+def add_approximation_arguments(parser):
+    parser.add_argument("-approx", "--kernel-approximation", default=None, choices=APPROXIMATIONS,
+                        help="Train the liblinear or sgd backend on an explicit feature map approximating the kernel instead of an exact SVC.")
+    parser.add_argument("-rank", "--approximation-rank", type=int, default=1000, help="Size of the Nystroem feature map.")
+    parser.add_argument("-approx-compare", "--approximation-compare-ranks", nargs='+', type=int, default=None,
+                        help="Compare the fit time and test accuracy of the exact SVC and the approximation, nystroem by default, at these ranks.")
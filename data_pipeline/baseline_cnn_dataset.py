@@ -7,20 +7,60 @@ import json
 from os import path
 import torch.nn as nn
 from PIL import Image
-from sklearn.decomposition import PCA
-from .utils import ToTensor, change_image_colourspace, Flatten, Rescale
+from .utils import ToTensor, change_image_colourspace, Flatten, Rescale, ChangeColourSpace, ToGrey, get_preprocess, report_preprocess_parity, get_feature_arrays
 from tqdm import tqdm
 from models.baseline_cnn import BaselineCNN
+from .feature_projection import get_reduced_features
+from .feature_cache import FeatureCache, images_fingerprint
+from .feature_store import features_to_matrix
+from .cnn_extraction import extract_features, check_batched_features
+from .exported_extractor import get_exported_extractor
 import cv2 as cv
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+def load_baseline_cnn(extractor_path, grey=False):
+    feature_extractor = BaselineCNN(grey=grey)
+    if not path.exists(extractor_path):
+        ValueError('No feature extractor found. Please train the baseline CNN model.')
+    print('Found a baseline CNN feature extractor')
+    checkpoint = torch.load(extractor_path, map_location=device)
+    feature_extractor.load_state_dict(checkpoint['model_state_dict'])
+    # use the running batch norm statistics, so an image's features do not depend on its batch
+    feature_extractor.eval()
+    return feature_extractor
+
+def get_baseline_feature_extractor(model):
+    # the layers up to fc3, with the ReLUs the forward pass applies as functions
+    children = list(model.children())
+    feature_extractor = nn.Sequential(*list(children[:2] + [nn.ReLU()] + children[2:4] + [nn.ReLU()] + [children[4]]+ [Flatten()] + children[5:-2]))
+    return feature_extractor.eval()
+
+def load_baseline_extractor(extractor_path, grey=False):
+    """The eager feature extractor of a trained baseline CNN checkpoint, in eval mode."""
+    return get_baseline_feature_extractor(load_baseline_cnn(extractor_path, grey))
+
 class BaselineCNNDataset(Dataset):
+    # increase when a change to this class changes the features it builds, so cached features are rebuilt
+    # version 2 runs the extractor in eval mode
+    feature_version = 2
 
-    def __init__(self, images, labels, label_amount, feature_path, extractor_path, reduced_dims=None, color_space=None, grey=False):
+    def __init__(self, images, labels, label_amount, feature_path, extractor_path, reduced_dims=None, color_space=None, grey=False, image_paths=None,
+                 extraction_batch_size=32, extraction_workers=0, fast_preprocess=False, interpolation='auto', channels_last=False,
+                 exported=False, quantized=False, projection_path=None, projection_solver='randomized'):
         self.images = images
         self.labels = labels
         self.label_amount = label_amount
+        self.extraction_batch_size = extraction_batch_size
+        self.extraction_workers = extraction_workers
+        # opencv resizing in place of skimage, see utils.get_preprocess
+        self.fast_preprocess = fast_preprocess
+        self.interpolation = interpolation
+        self.channels_last = channels_last
+        # extract with the frozen TorchScript export of the extractor, see exported_extractor
+        self.exported = exported
+        # int8 Linear layers, the quantized extractor is exported so it is only quantized once
+        self.quantized = quantized
         self.color_space = color_space
         self.grey = grey
         curr_dir = path.dirname(path.realpath(__file__))
@@ -30,58 +70,72 @@ class BaselineCNNDataset(Dataset):
         elif grey:
             self.extractor_path += '_grey'
         assert len(self.images) == len(self.labels)
-        full_feature_path = path.join(curr_dir, feature_path)
-        if path.exists(full_feature_path):
-            print('Loading pretrained baseline CNN features from', full_feature_path)
-            self.features = torch.load(full_feature_path, map_location=device)
-        else:
-            if not grey and color_space is not None:
-                self.images = [change_image_colourspace(self.color_space, image) for image in self.images]
-            elif grey:
-                self.images = [cv.cvtColor(image, cv.COLOR_BGR2GRAY) for image in self.images]
+        feature_folder, feature_name = path.split(path.join(curr_dir, feature_path))
+        cache = FeatureCache(feature_folder)
+        # the checkpoint checksum ties the features to the extractor they were built with
+        extractor_checksum = cache.file_checksum(self.extractor_path) if path.exists(self.extractor_path) else None
+        cache_key = [self.feature_version, images_fingerprint(self.images, image_paths), color_space, grey, extractor_checksum]
+        if fast_preprocess:
+            cache_key += ['opencv', interpolation]
+        if exported:
+            # folding the batch norm changes the rounding of the features
+            cache_key += ['exported']
+        if quantized:
+            cache_key += ['int8']
+        self.features = cache.load(feature_name, cache_key)
+        if self.features is None:
             self.get_features_for_images()
-            print('Saving baseline CNN features to', full_feature_path)
-            torch.save(self.features, full_feature_path)
-        # since the features come from a CNN they are batched tensors
-        self.features = [f[0].cpu().numpy() for f in self.features]        
+            # the CNN gives a batched tensor per image, these are stored as one (N, D) matrix
+            self.features = features_to_matrix(self.features)
+            cache.store(feature_name, cache_key, self.features)
+        # the images are not needed once their features are built
+        self.images = None
+        # the test features are reduced with the projection of the training features, given by their dataset's projection_path
+        self.projection_path = projection_path
         if reduced_dims is not None:
-            reduced_features_path = path.join(curr_dir, feature_path + "_reduced_" + reduced_dims)
-            if path.exists(reduced_features_path):
-                print('Loading reduced imagened features from', reduced_features_path)
-                self.features = pickle.load(open(reduced_features_path, "rb"))            
-            else:
-                print('Building reduced features of size', reduced_dims)
-                pca = PCA(n_components=reduced_dims)
-                self.features = pca.fit_transform(self.features)
-                print('Saving reduced imagened features to', reduced_features_path)
-                pickle.dump(self.features, open(reduced_features_path, "wb"))
+            # without a projection path these are the training features, the projection is fitted on them and saved next to them
+            fit_projection = projection_path is None
+            if fit_projection:
+                self.projection_path = path.join(feature_folder, feature_name + '_projection_' + str(reduced_dims))
+            self.features = get_reduced_features(cache, self.features, feature_name + "_reduced_" + str(reduced_dims), cache_key, reduced_dims,
+                                                 self.projection_path, fit_projection, projection_solver)
 
     def get_features_for_images(self):
-        preprocess = transforms.Compose([
-            Rescale(256),
-            ToTensor(self.grey),
-        ])
+        # images are converted one at a time as they are preprocessed, instead of converting the whole list up front
+        conversion = transforms.Compose([])
+        if not self.grey and self.color_space is not None:
+            conversion = ChangeColourSpace(self.color_space)
+        elif self.grey:
+            conversion = ToGrey()
+        preprocess = transforms.Compose([conversion, get_preprocess(self.grey, 256, self.fast_preprocess, self.interpolation, self.channels_last)])
+        if self.fast_preprocess:
+            converted = [conversion(self.images[idx]) for idx in range(min(4, len(self.images)))]
+            report_preprocess_parity(converted, self.grey, 256, self.interpolation)
         # enable GPU
-        model = self.load_trained_extractor()
-        children = list(model.children())
-        feature_extractor = nn.Sequential(*list(children[:2] + [nn.ReLU()] + children[2:4] + [nn.ReLU()] + [children[4]]+ [Flatten()] + children[5:-2]))
-        feature_extractor.to(device)
+        load_eager_extractor = lambda: get_baseline_feature_extractor(self.load_trained_extractor())
+        if self.exported or self.quantized:
+            example_batch = preprocess(self.images[0]).unsqueeze(0)
+            feature_extractor = get_exported_extractor(load_eager_extractor, example_batch, self.extractor_path, ['baseline', self.grey],
+                                                       self.channels_last, self.quantized)
+        else:
+            feature_extractor = load_eager_extractor()
+            feature_extractor.to(device)
         print('Getting Baseline CNN features for', len(self.images), 'images')
-        with torch.no_grad():
-            self.features = [feature_extractor(preprocess(image).unsqueeze(0).to(device)) for image in tqdm(self.images)]
+        self.features = extract_features(feature_extractor, self.images, preprocess, device, self.extraction_batch_size, self.extraction_workers,
+                                         self.channels_last)
+        # int8 activations are quantized with the range of the whole batch, so batched features are only close to single image ones
+        check_batched_features(feature_extractor, self.images, preprocess, device, self.features, tolerance=0.05 if self.quantized else 1e-4)
         print('Got features for images')
 
     def load_trained_extractor(self):
-        feature_extractor = BaselineCNN(grey=self.grey)
-        if not path.exists(self.extractor_path):
-            ValueError('No feature extractor found. Please train the baseline CNN model.')
-        print('Found a baseline CNN feature extractor')
-        checkpoint = torch.load(self.extractor_path, map_location=device)
-        feature_extractor.load_state_dict(checkpoint['model_state_dict'])
-        return feature_extractor
+        return load_baseline_cnn(self.extractor_path, self.grey)
             
+    def as_arrays(self):
+        """The (N, D) features and (N,) labels, the features are not copied."""
+        return get_feature_arrays(self.features, self.labels)
+
     def __len__(self):
-        return len(self.images)
+        return len(self.features)
 
     def __getitem__(self, idx):
         return self.features[idx], self.labels[idx]
@@ -0,0 +1,71 @@
+import numpy as np
+from .descriptor_arena import DescriptorArena
+
+def assign_words(descriptors, centres, chunk_size=4096):
+    """Index of the nearest vocabulary centre for every descriptor, computed in chunks of descriptors."""
+    centres = np.asarray(centres, dtype=np.float32)
+    centre_norms = (centres ** 2).sum(axis=1)
+    words = np.empty(len(descriptors), dtype=np.int64)
+    for start in range(0, len(descriptors), chunk_size):
+        chunk = np.asarray(descriptors[start:start + chunk_size], dtype=np.float32)
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2 and |x|^2 is the same for every centre
+        distances = centre_norms - 2 * chunk.dot(centres.T)
+        words[start:start + chunk_size] = distances.argmin(axis=1)
+    return words
+
+def assign_vocabulary_words(descriptors, vocabulary, chunk_size=4096):
+    """Words of the descriptors in a vocabulary tree or in a flat vocabulary given as a matrix of centres."""
+    if hasattr(vocabulary, 'predict'):
+        return vocabulary.predict(descriptors)
+    return assign_words(descriptors, vocabulary, chunk_size)
+
+def vocabulary_dims(vocabulary):
+    if hasattr(vocabulary, 'dims'):
+        return vocabulary.dims
+    return np.asarray(vocabulary).shape[1]
+
+def normalise_histograms(histograms, normalisation):
+    if normalisation is None:
+        return histograms
+    if normalisation not in ('l1', 'density'):
+        raise ValueError('Normalisation', normalisation, 'not supported')
+    # the histogram bins have width one, so the density is the L1 normalised histogram
+    totals = histograms.sum(axis=1, keepdims=True)
+    # images without descriptors keep an all zero histogram
+    np.divide(histograms, totals, out=histograms, where=totals > 0)
+    return histograms
+
+def build_histograms(words, offsets, vocabulary_size, normalisation='density'):
+    """Build the BoW histograms of all images with one bincount.
+
+    Args:
+        words (ndarray): The word of every descriptor, grouped by image.
+        offsets (ndarray): The words of image i are words[offsets[i]:offsets[i+1]].
+        vocabulary_size (int): Amount of words in the vocabulary.
+        normalisation (string, optional): 'l1', 'density' or None for raw counts.
+    """
+    counts = np.diff(offsets)
+    image_ids = np.repeat(np.arange(len(counts)), counts)
+    histograms = np.bincount(image_ids * vocabulary_size + words, minlength=len(counts) * vocabulary_size)
+    histograms = histograms.reshape(len(counts), vocabulary_size).astype(np.float32)
+    return normalise_histograms(histograms, normalisation)
+
+def encode_bow(descriptors, offsets, vocabulary, normalisation='density', chunk_size=4096):
+    words = assign_vocabulary_words(descriptors, vocabulary, chunk_size)
+    return build_histograms(words, offsets, len(vocabulary), normalisation)
+
+def encode_bow_stream(descriptors, vocabulary, normalisation='density', batch_size=65536):
+    """Encode an iterable of per image descriptors, holding about batch_size descriptors at a time."""
+    dims = vocabulary_dims(vocabulary)
+    arena = DescriptorArena(dims)
+    histograms = []
+    for desc in descriptors:
+        arena.append(desc)
+        if len(arena.descriptors) >= batch_size:
+            histograms.append(encode_bow(arena.descriptors, arena.offsets, vocabulary, normalisation))
+            arena = DescriptorArena(dims)
+    if len(arena) > 0:
+        histograms.append(encode_bow(arena.descriptors, arena.offsets, vocabulary, normalisation))
+    if not histograms:
+        return np.zeros((0, len(vocabulary)), dtype=np.float32)
+    return np.concatenate(histograms)
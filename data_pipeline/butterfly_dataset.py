@@ -4,26 +4,36 @@ import pandas as pd
 import os
 import cv2 as cv
 from .utils import change_image_colourspace
+from .image_shards import load_image_shard
+from .split_index import SplitIndex, load_species_names
 
 class ButterflyDataset(Dataset):
     """Butterfly 200 dataset."""
 
-    def __init__(self, indices_file, species_file, root_dir, grey, label_i, color_space=None, transform=None, length=None):
+    def __init__(self, indices_file, species_file, root_dir, grey, label_i, color_space=None, transform=None, length=None, shard_path=None):
         """
         Args:
             indice_file (string): Path to the csv file split annotations.
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            shard_path (string, optional): Image shard of the split built with build_image_shards.py,
+                its images are already converted and resized so they are not read from root_dir.
         """
-        self.indices = pd.read_csv(indices_file, sep=' ', header=None)
-        self.idx2species = pd.read_csv(species_file, sep=' ', index_col=0, header=None)
+        # compact arrays instead of DataFrames, so forked workers do not copy them by touching refcounts
+        self.indices = SplitIndex(indices_file)
+        self.species_names = load_species_names(species_file)
         self.root_dir = root_dir
         self.transform = transform
         self.grey = grey
         self.length = length if length is not None else len(self.indices)
         self.label_i = label_i
         self.color_space = color_space
+        self.shard_images = None
+        if shard_path is not None:
+            print('Reading images from shard', shard_path)
+            self.shard_images, self.shard_labels = load_image_shard(shard_path)
+            assert len(self.shard_images) == len(self.indices)
 
     def __len__(self):
         return self.length
@@ -31,20 +41,27 @@ class ButterflyDataset(Dataset):
     def index2species(self, index):
         if torch.is_tensor(index):
             index = index.tolist()
-        return [self.idx2species.loc[i].values[0] for i in index]
+        return [str(name) for name in self.species_names[index]]
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         
-        label_index = self.indices.iloc[idx, self.label_i]
-        img_path = os.path.join(self.root_dir, self.indices.iloc[idx, 0])
+        if self.shard_images is not None:
+            # the label columns of the shard start at the first label index
+            sample = (self.shard_images[idx], self.shard_labels[idx, self.label_i - 1])
+            if self.transform:
+                sample = self.transform(sample)
+            return sample
+
+        label_index = self.indices.label(idx, self.label_i)
+        img_path = os.path.join(self.root_dir, self.indices.image_path(idx))
         image = cv.imread(img_path)
         if self.grey:
             image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-        sample = (image, label_index)
         if not self.grey and self.color_space is not None:
             image = change_image_colourspace(self.color_space, image)
+        sample = (image, label_index)
         if self.transform:
             sample = self.transform(sample)
 
@@ -0,0 +1,73 @@
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+class PreprocessedImages(Dataset):
+    """Images preprocessed on access, so DataLoader workers can preprocess while the CNN runs."""
+
+    def __init__(self, images, preprocess):
+        self.images = images
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.preprocess(self.images[idx])
+
+def extract_features(feature_extractor, images, preprocess, device, batch_size=32, workers=0, channels_last=False):
+    """Run a feature extractor over the images in batches.
+
+    Args:
+        feature_extractor (nn.Module): Maps a batch of preprocessed images to (batch, D) features, in eval mode.
+        images (list): The images to extract features from, a list or an ImageSource.
+        preprocess (callable): Turns an image into a tensor.
+        device (torch.device): Device the extractor runs on.
+        batch_size (int): Amount of images in a forward pass.
+        workers (int): Amount of DataLoader processes preprocessing images, 0 preprocesses in this process.
+        channels_last (bool): Run the extractor on channels last batches, which is faster for convolutions on CPU.
+
+    Returns:
+        ndarray: The (N, D) float32 features, row i belongs to image i.
+    """
+    loader = DataLoader(PreprocessedImages(images, preprocess), batch_size=batch_size, shuffle=False,
+                        num_workers=workers, pin_memory=device.type == 'cuda')
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    if channels_last:
+        feature_extractor = feature_extractor.to(memory_format=memory_format)
+    features = None
+    start = time.time()
+    with torch.inference_mode():
+        row = 0
+        for batch in tqdm(loader):
+            batch = batch.to(device, non_blocking=True)
+            if batch.dim() == 4:
+                batch = batch.contiguous(memory_format=memory_format)
+            batch_features = feature_extractor(batch)
+            batch_features = batch_features.reshape(len(batch), -1).cpu().numpy()
+            if features is None:
+                # the feature size is only known after the first batch
+                features = np.empty((len(images), batch_features.shape[1]), dtype=np.float32)
+            features[row:row + len(batch)] = batch_features
+            row += len(batch)
+    duration = time.time() - start
+    print('Extracted features for', len(images), 'images in', duration, 's,', len(images) / max(duration, 1e-9), 'images/s')
+    if features is None:
+        return np.empty((0, 0), dtype=np.float32)
+    return features
+
+def check_batched_features(feature_extractor, images, preprocess, device, features, amount=2, tolerance=1e-4):
+    """Compare the batched features of the first images with extracting them one at a time."""
+    amount = min(amount, len(images))
+    single = []
+    with torch.no_grad():
+        for idx in range(amount):
+            single.append(feature_extractor(preprocess(images[idx]).unsqueeze(0).to(device)).reshape(-1).cpu().numpy())
+    if amount == 0:
+        return
+    difference = np.abs(np.stack(single) - features[:amount]).max()
+    print('Largest difference between batched and single image features', difference)
+    if difference > tolerance * max(1, np.abs(features[:amount]).max()):
+        raise ValueError('Batched features differ from single image features by', difference)
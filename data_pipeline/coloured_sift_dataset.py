@@ -5,84 +5,124 @@ import torch
 from os import path
 import time
 import numpy as np
-from .utils import change_image_colourspace
+from .utils import change_image_colourspace, get_feature_arrays
+from functools import partial
+from .sift_extraction import iter_sift, coloured_descriptors, colour_space_descriptors
+from .descriptor_arena import DescriptorArena
+from .vocabulary import StreamingVocabularyTrainer, sample_descriptors
+from .bow_encoding import encode_bow, encode_bow_stream
+from .vocabulary_tree import VocabularyTree, train_vocabulary_tree, get_vocabulary_name
+from .feature_cache import FeatureCache, images_fingerprint
 from sklearn.cluster import MiniBatchKMeans
 
 class ColouredSIFTDataset(Dataset):
+    # increase when a change to this class changes the features it builds, so cached features are rebuilt
+    feature_version = 1
 
-    def __init__(self, images, labels, feature_folder, vocabulary_size, color_space, test=False):
-        self.images = np.asarray(images)
-        if self.images.shape[-1] != 3:
+    def __init__(self, images, labels, feature_folder, vocabulary_size, color_space, test=False, workers=1, chunk_size=16, streaming_batch_size=None,
+                 vocabulary_sample_size=None, sample_seed=0, normalisation='density', vocabulary_tree=None, image_paths=None):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.streaming_batch_size = streaming_batch_size
+        self.vocabulary_sample_size = vocabulary_sample_size
+        self.sample_seed = sample_seed
+        self.normalisation = normalisation
+        # (branching, depth) of a hierarchical vocabulary used instead of flat k-means
+        self.vocabulary_tree = vocabulary_tree
+        # a list of images or an ImageSource, the images are converted one at a time when needed
+        self.images = images
+        if len(self.images) > 0 and np.shape(self.images[0])[-1] != 3:
             raise ValueError('Images need to have colour to form a coloured SIFT dataset')
         self.labels = labels
         assert len(self.images) == len(self.labels)
-        self.grey_images = [cv.cvtColor(image, cv.COLOR_BGR2GRAY) for image in self.images]
-        self.convert_images_to_colorspace(color_space)
         self.test = test
+        self.color_space = color_space
         test_id = '_test' if self.test else ''
-        self.trained_kmeans_path = path.join(feature_folder, 'trained_kmeans' + color_space + '_' + str(vocabulary_size))
-        full_feature_path = path.join(feature_folder, 'coloured_sift_' + color_space + '_' + str(vocabulary_size) + test_id)
-        if path.exists(full_feature_path):
-            print('Loading SIFT features from', full_feature_path)
-            self.features = pickle.load(open(full_feature_path, "rb"))
-        else:
+        self.vocabulary_name = get_vocabulary_name(vocabulary_size, vocabulary_tree)
+        self.trained_kmeans_path = path.join(feature_folder, 'trained_kmeans' + color_space + '_' + self.vocabulary_name)
+        feature_name = 'coloured_sift_' + color_space + '_' + self.vocabulary_name + test_id
+        cache = FeatureCache(feature_folder)
+        image_fingerprint = images_fingerprint(self.images, image_paths)
+        self.features = cache.load(feature_name, self.get_cache_key(cache, image_fingerprint))
+        if self.features is None:
             self.features = self.get_coloured_bow_features(vocabulary_size)
-            pickle.dump(self.features, open(full_feature_path, "wb"))
-            print('Saving SIFT features to', full_feature_path)
+            cache.store(feature_name, self.get_cache_key(cache, image_fingerprint), self.features)
+        # the images are not needed once their features are built
+        self.images = None
 
-    def convert_images_to_colorspace(self, color_space):
-        self.images = [change_image_colourspace(color_space, image) for image in self.images]
+    def get_cache_key(self, cache, image_fingerprint):
+        # the k-means checksum ties the features to the vocabulary they were encoded with
+        kmeans_checksum = cache.file_checksum(self.trained_kmeans_path) if path.exists(self.trained_kmeans_path) else None
+        return [self.feature_version, image_fingerprint, self.color_space, self.vocabulary_name, self.normalisation, self.test,
+                self.streaming_batch_size, self.vocabulary_sample_size, self.sample_seed, kmeans_checksum]
 
     def get_coloured_descriptors(self, image, grey_image, sift):
-        # the features from different image dimensions are concatenated together
-        keypoints = sift.detect(grey_image)
-        concat_desc = None
-        for dim in range(3):
-            color_dim_image = image[:, :, dim]
-            keypoints, desc = sift.compute(color_dim_image, keypoints)
-            if concat_desc is None:
-                concat_desc = desc
-            else:
-                concat_desc = np.concatenate((concat_desc, desc), axis=1)
-        return concat_desc
+        return coloured_descriptors((image, grey_image), sift)
+
+    def iter_coloured_descriptors(self):
+        return iter_sift(partial(colour_space_descriptors, self.color_space), self.images, self.workers, self.chunk_size)
+
+    def get_descriptor_arena(self):
+        # one SIFT descriptor per colour dimension
+        arena = DescriptorArena(3 * 128)
+        print('Getting descriptors for images')
+        for concat_desc in self.iter_coloured_descriptors():
+            arena.append(concat_desc)
+        print('Got', len(arena.descriptors), 'descriptors')
+        return arena
+
+    def train_kmeans(self, arena, vocabulary_size):
+        descriptors = [arena.descriptors] if arena is not None else self.iter_coloured_descriptors()
+        if self.vocabulary_sample_size is not None:
+            # the vocabulary is clustered from a sample, the histograms still use every descriptor
+            descriptors = [sample_descriptors(descriptors, self.vocabulary_sample_size, self.sample_seed)]
+        if self.vocabulary_tree is not None:
+            if not isinstance(descriptors, list):
+                raise ValueError('A vocabulary tree can not be trained from streamed descriptors, use a descriptor sample instead')
+            branching, depth = self.vocabulary_tree
+            return train_vocabulary_tree(descriptors[0], branching, depth)
+        if self.streaming_batch_size is not None:
+            print('Training streaming Kmeans with size', vocabulary_size)
+            trainer = StreamingVocabularyTrainer(vocabulary_size, self.streaming_batch_size)
+            for concat_desc in descriptors:
+                trainer.add(concat_desc)
+            return trainer.cluster()
+        descriptors = descriptors[0]
+        print('Training Kmeans with size', vocabulary_size, 'on', len(descriptors), 'descriptors')
+        kmeans = MiniBatchKMeans(n_clusters=vocabulary_size, random_state=0)
+        start = time.time()
+        kmeans = kmeans.fit(descriptors)
+        end = time.time()
+        print('Training took', (end-start)/60, 'minutes')
+        return kmeans
 
     def get_coloured_bow_features(self, vocabulary_size):
         print('Building BOW vocabulary for', len(self.images), 'images')
-        sift = cv.xfeatures2d.SIFT_create()
-        kmeans = MiniBatchKMeans(n_clusters=vocabulary_size, random_state=0)
-        all_descriptors = None
-        image_descriptors = []
-        sift = cv.xfeatures2d.SIFT_create()
-        print('Getting descriptors for images')
-        for image, grey_image in zip(self.images, self.grey_images):
-            concat_desc = self.get_coloured_descriptors(image, grey_image, sift)
-            if all_descriptors is None:
-                all_descriptors = concat_desc
-            else:
-                all_descriptors = np.concatenate((all_descriptors, concat_desc), axis=0)
-            image_descriptors.append(concat_desc)
+        # when streaming, descriptors are not kept in memory but extracted again for the histograms
+        arena = None
+        if self.streaming_batch_size is None:
+            arena = self.get_descriptor_arena()
         if self.test:
             print('Loading trained Kmeans from', self.trained_kmeans_path)
             kmeans = pickle.load(open(self.trained_kmeans_path, 'rb'))
         else:
-            print('Training Kmeans with size', vocabulary_size)
-            start = time.time()
-            kmeans = kmeans.fit(all_descriptors)
-            end = time.time()
-            print('Training took', (end-start)/60, 'minutes')
+            kmeans = self.train_kmeans(arena, vocabulary_size)
             print('Saving trained Kmeans to', self.trained_kmeans_path)
             with open(self.trained_kmeans_path, 'wb') as f:
                 pickle.dump(kmeans, f)
-        bow_features = np.zeros((len(self.images), vocabulary_size))
-        for i, descriptors in enumerate(image_descriptors):
-            # the features from different image dimensions are concatenated together
-            clusters = kmeans.predict(descriptors)
-            bow_vector = np.histogram(clusters, bins=np.arange(vocabulary_size+1), density=True)[0]
-            bow_features[i] = bow_vector
-        return bow_features
+        vocabulary = kmeans if isinstance(kmeans, VocabularyTree) else kmeans.cluster_centers_
+        # the descriptors used for the vocabulary are reused, only streaming extracts them again
+        if arena is not None:
+            return encode_bow(arena.descriptors, arena.offsets, vocabulary, self.normalisation)
+        return encode_bow_stream(self.iter_coloured_descriptors(), vocabulary, self.normalisation, self.streaming_batch_size)
+
+    def as_arrays(self):
+        """The (N, D) features and (N,) labels, the features are not copied."""
+        return get_feature_arrays(self.features, self.labels)
 
     def __len__(self):
         return len(self.features)
 
     def __getitem__(self, idx):
-        return torch.Tensor(self.features[idx]), self.labels[idx]
+        # the row is a view of the memory mapped features, so no copy is made
+        return torch.from_numpy(self.features[idx]), self.labels[idx]
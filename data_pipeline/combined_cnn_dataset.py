@@ -5,13 +5,14 @@ import torch
 from os import path
 import time
 import numpy as np
-from .utils import change_image_colourspace
+from .utils import change_image_colourspace, get_feature_arrays
 from sklearn.cluster import MiniBatchKMeans
-from sklearn.decomposition import PCA
+from .feature_cache import FeatureCache
+from .feature_projection import get_reduced_features
 
 class CombinedCNNDataset(Dataset):
 
-    def __init__(self, labels, feature_folder, grey, test=False, reduced_dims=None):
+    def __init__(self, labels, feature_folder, grey, test=False, reduced_dims=None, projection_solver='randomized'):
         self.labels = labels
         self.test = test
         test_id = '_test' if self.test else ''
@@ -19,34 +20,35 @@ class CombinedCNNDataset(Dataset):
         if grey:
             supported_colour_spaces.append('grey')
         self.features = None
+        cache = FeatureCache(feature_folder)
+        # the keys of the features combined here identify the reduced features
+        feature_keys = []
         for i, colour_space in enumerate(supported_colour_spaces):
-            full_feature_path = path.join(feature_folder, 'baseline_cnn_features_' + colour_space + test_id)
-            if path.exists(full_feature_path):
-                print('Loading CNN features from', full_feature_path)
-                colour_features = torch.load(full_feature_path, map_location=torch.device('cpu'))
-                colour_features = [f[0].cpu().numpy() for f in colour_features]   
-                assert len(colour_features) == len(labels)
-                if self.features is None:
-                    self.features = colour_features
-                else:
-                    self.features = np.concatenate((self.features, colour_features), axis=1)
+            feature_name = 'baseline_cnn_features_' + colour_space + test_id
+            feature_key, colour_features = cache.latest(feature_name)
+            if feature_key is None:
+                raise ValueError('Could not find features', feature_name, 'in', feature_folder)
+            assert len(colour_features) == len(labels)
+            feature_keys.append(feature_key)
+            if self.features is None:
+                self.features = colour_features
             else:
-                raise ValueError('Could not find path', full_feature_path)
+                self.features = np.concatenate((self.features, colour_features), axis=1)
         if reduced_dims is not None:
-            reduced_features_path = "combined_cnn_reduced_" + str(reduced_dims)
-            if path.exists(reduced_features_path):
-                print('Loading reduced features from', reduced_features_path)
-                self.features = pickle.load(open(reduced_features_path, "rb"))            
-            else:
-                print('Building reduced features of size', reduced_dims)
-                pca = PCA(n_components=reduced_dims)
-                self.features = pca.fit_transform(self.features)
-                print('Saving reduced features to', reduced_features_path)
-                pickle.dump(self.features, open(reduced_features_path, "wb"))
+            # the projection is fitted on the training features and applied to the test features, like the SIFT vocabulary
+            projection_path = path.join(feature_folder, "combined_cnn_projection_" + str(reduced_dims))
+            reduced_name = "combined_cnn_reduced_" + str(reduced_dims) + test_id
+            self.features = get_reduced_features(cache, self.features, reduced_name, feature_keys, reduced_dims, projection_path,
+                                                 not self.test, projection_solver)
         print('Got combined features of shape', self.features.shape)
 
+    def as_arrays(self):
+        """The (N, D) features and (N,) labels, the features are not copied."""
+        return get_feature_arrays(self.features, self.labels)
+
     def __len__(self):
         return len(self.features)
 
     def __getitem__(self, idx):
-        return torch.Tensor(self.features[idx]), self.labels[idx]
+        # the row is a view of the memory mapped features, so no copy is made
+        return torch.from_numpy(self.features[idx]), self.labels[idx]
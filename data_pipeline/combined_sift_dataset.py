@@ -5,13 +5,14 @@ import torch
 from os import path
 import time
 import numpy as np
-from .utils import change_image_colourspace
+from .utils import change_image_colourspace, get_feature_arrays
 from sklearn.cluster import MiniBatchKMeans
-from sklearn.decomposition import PCA
+from .feature_cache import FeatureCache
+from .feature_projection import get_reduced_features
 
 class CombinedSIFTDataset(Dataset):
 
-    def __init__(self, labels, feature_folder, vocabulary_size, grey, test=False, reduced_dims=None):
+    def __init__(self, labels, feature_folder, vocabulary_size, grey, test=False, reduced_dims=None, projection_solver='randomized'):
         self.labels = labels
         self.test = test
         test_id = '_test' if self.test else ''
@@ -19,34 +20,39 @@ class CombinedSIFTDataset(Dataset):
         if grey:
             supported_colour_spaces.append('grey')
         self.features = None
+        cache = FeatureCache(feature_folder)
+        # the keys of the features combined here identify the reduced features
+        feature_keys = []
         for i, colour_space in enumerate(supported_colour_spaces):
-            full_feature_path = path.join(feature_folder, 'sift_features_' + colour_space + '_' + str(vocabulary_size) + test_id)
-            if path.exists(full_feature_path):
-                print('Loading SIFT features from', full_feature_path)
-                colour_features = pickle.load(open(full_feature_path, "rb"))
-                assert len(colour_features[0]) == vocabulary_size
-                assert len(colour_features) == len(labels)
-                if self.features is None:
-                    self.features = colour_features
-                else:
-                    self.features = np.concatenate((self.features, colour_features), axis=1)
+            if colour_space == 'grey':
+                feature_name = 'sift_features_grey_' + str(vocabulary_size) + test_id
             else:
-                raise ValueError('Could not find path', full_feature_path)
-        if reduced_dims is not None:
-            reduced_features_path = path.join(feature_folder, "combined_sift_reduced_" + str(reduced_dims) + test_id)
-            if path.exists(reduced_features_path):
-                print('Loading reduced imagener features from', reduced_features_path)
-                self.features = pickle.load(open(reduced_features_path, "rb"))            
+                feature_name = 'coloured_sift_' + colour_space + '_' + str(vocabulary_size) + test_id
+            feature_key, colour_features = cache.latest(feature_name)
+            if feature_key is None:
+                raise ValueError('Could not find features', feature_name, 'in', feature_folder)
+            assert len(colour_features[0]) == vocabulary_size
+            assert len(colour_features) == len(labels)
+            feature_keys.append(feature_key)
+            if self.features is None:
+                self.features = colour_features
             else:
-                print('Building reduced features of size', reduced_dims)
-                pca = PCA(n_components=reduced_dims)
-                self.features = pca.fit_transform(self.features)
-                print('Saving reduced imagened features to', reduced_features_path)
-                pickle.dump(self.features, open(reduced_features_path, "wb"))            
+                self.features = np.concatenate((self.features, colour_features), axis=1)
+        if reduced_dims is not None:
+            # the projection is fitted on the training features and applied to the test features, like the SIFT vocabulary
+            projection_path = path.join(feature_folder, "combined_sift_projection_" + str(vocabulary_size) + '_' + str(reduced_dims))
+            reduced_name = "combined_sift_reduced_" + str(reduced_dims) + test_id
+            self.features = get_reduced_features(cache, self.features, reduced_name, feature_keys, reduced_dims, projection_path,
+                                                 not self.test, projection_solver)
         print('Got combined features of shape', self.features.shape)
 
+    def as_arrays(self):
+        """The (N, D) features and (N,) labels, the features are not copied."""
+        return get_feature_arrays(self.features, self.labels)
+
     def __len__(self):
         return len(self.features)
 
     def __getitem__(self, idx):
-        return torch.Tensor(self.features[idx]), self.labels[idx]
+        # the row is a view of the memory mapped features, so no copy is made
+        return torch.from_numpy(self.features[idx]), self.labels[idx]
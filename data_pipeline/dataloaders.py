@@ -8,49 +8,67 @@ from .coloured_sift_dataset import ColouredSIFTDataset
 from .baseline_cnn_dataset import BaselineCNNDataset
 from .combined_sift_dataset import CombinedSIFTDataset
 from .combined_cnn_dataset import CombinedCNNDataset
-from .utils import SampleRescale, SampleToTensor
+from .utils import SampleRescale, SampleToTensor, SampleScale, SampleFastRescale, SampleToFloatTensor
+from .image_shards import get_shard_path
 
-def get_butterfly_dataloader(image_root, index_file, species_file, batch_size, label_i, grey=False, length=None, color_space=None):
+def get_butterfly_dataloader(image_root, index_file, species_file, batch_size, label_i, grey=False, length=None, color_space=None, shard_folder=None,
+                             fast_preprocess=False, interpolation='auto'):
+    shard_path = None
+    if shard_folder is not None:
+        shard_path = get_shard_path(shard_folder, index_file, color_space, grey)
+    # images in a shard are already resized, they only need to be scaled like SampleRescale does
+    if fast_preprocess:
+        sample_transforms = [SampleToFloatTensor(grey)]
+        if shard_path is None:
+            sample_transforms = [SampleFastRescale(256, interpolation)] + sample_transforms
+    else:
+        sample_transforms = [SampleScale() if shard_path is not None else SampleRescale(256), SampleToTensor(grey)]
     butterfly_dataset = ButterflyDataset(indices_file=index_file,
                                         root_dir=image_root,
                                         species_file=species_file,
                                         grey=grey,
-                                        transform=transforms.Compose([
-                                               SampleRescale(256),
-                                               SampleToTensor(grey)
-                                        ]),
+                                        transform=transforms.Compose(sample_transforms),
                                         length=length,
                                         label_i=label_i,
-                                        color_space=color_space)
+                                        color_space=color_space,
+                                        shard_path=shard_path)
     dataloader = DataLoader(butterfly_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
 
-def get_sift_dataloader(images, labels, feature_folder, batch_size, feature_size, test=False):
-    sift_dataset = SIFTDataset(images, labels, feature_folder, feature_size, test)
+def get_sift_dataloader(images, labels, feature_folder, batch_size, feature_size, test=False, **sift_options):
+    # sift_options are passed on to SIFTDataset, e.g. workers, streaming_batch_size or image_paths
+    sift_dataset = SIFTDataset(images, labels, feature_folder, feature_size, test, **sift_options)
     dataloader = DataLoader(sift_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
 
-def get_coloured_sift_dataloader(images, labels, feature_folder, batch_size, colour_space, feature_size, test=False):
-    sift_dataset = ColouredSIFTDataset(images, labels, feature_folder, feature_size, colour_space, test)
+def get_coloured_sift_dataloader(images, labels, feature_folder, batch_size, colour_space, feature_size, test=False, **sift_options):
+    sift_dataset = ColouredSIFTDataset(images, labels, feature_folder, feature_size, colour_space, test, **sift_options)
     dataloader = DataLoader(sift_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
 
-def get_pretrained_imagenet_dataloader(images, labels, label_amount, batch_size, feature_path, extractor_path, reduced_dims=None):
-    imagenet_dataset = PretrainedImagenet(images, labels, label_amount, feature_path, extractor_path, reduced_dims)
+def get_pretrained_imagenet_dataloader(images, labels, label_amount, batch_size, feature_path, extractor_path, reduced_dims=None, image_paths=None,
+                                       extraction_batch_size=32, extraction_workers=0, **preprocess_options):
+    # preprocess_options are fast_preprocess, interpolation, channels_last and exported, and projection_path and projection_solver
+    # of the reduced features
+    imagenet_dataset = PretrainedImagenet(images, labels, label_amount, feature_path, extractor_path, reduced_dims, image_paths=image_paths,
+                                          extraction_batch_size=extraction_batch_size, extraction_workers=extraction_workers, **preprocess_options)
     dataloader = DataLoader(imagenet_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
 
-def get_baseline_cnn_dataloader(images, labels, label_amount, batch_size, feature_path, extractor_path, color_space=None, grey=False, reduced_dims=None):
-    cnn_dataset = BaselineCNNDataset(images, labels, label_amount, feature_path, extractor_path, reduced_dims, color_space=color_space, grey=grey)
+def get_baseline_cnn_dataloader(images, labels, label_amount, batch_size, feature_path, extractor_path, color_space=None, grey=False, reduced_dims=None,
+                                image_paths=None, extraction_batch_size=32, extraction_workers=0, **preprocess_options):
+    cnn_dataset = BaselineCNNDataset(images, labels, label_amount, feature_path, extractor_path, reduced_dims, color_space=color_space, grey=grey,
+                                     image_paths=image_paths, extraction_batch_size=extraction_batch_size, extraction_workers=extraction_workers,
+                                     **preprocess_options)
     dataloader = DataLoader(cnn_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
 
-def get_combined_sift_dataloader(labels, batch_size, feature_folder, vocabulary_size, grey, test=False):
-    combined_dataset = CombinedSIFTDataset(labels, feature_folder, vocabulary_size, grey, test)
+def get_combined_sift_dataloader(labels, batch_size, feature_folder, vocabulary_size, grey, test=False, reduced_dims=None, projection_solver='randomized'):
+    combined_dataset = CombinedSIFTDataset(labels, feature_folder, vocabulary_size, grey, test, reduced_dims, projection_solver)
     dataloader = DataLoader(combined_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
 
-def get_combined_cnn_dataloader(labels, batch_size, feature_folder, grey, test=False):
-    combined_dataset = CombinedCNNDataset(labels, feature_folder, grey, test)
+def get_combined_cnn_dataloader(labels, batch_size, feature_folder, grey, test=False, reduced_dims=None, projection_solver='randomized'):
+    combined_dataset = CombinedCNNDataset(labels, feature_folder, grey, test, reduced_dims, projection_solver)
     dataloader = DataLoader(combined_dataset, batch_size=batch_size, shuffle=True)
     return dataloader
@@ -0,0 +1,60 @@
+import numpy as np
+
+class DescriptorArena(object):
+    """Descriptors of many images stored in one contiguous float32 buffer.
+
+    The buffer grows geometrically, so appending N images copies O(N) bytes in total.
+    The rows of image i are descriptors[offsets[i]:offsets[i+1]].
+
+    Args:
+        dims (int): Length of a single descriptor.
+        capacity (int): Amount of descriptor rows to allocate up front.
+        growth (float): Factor the buffer grows with when it is full.
+    """
+
+    def __init__(self, dims, capacity=1024, growth=2.0):
+        assert growth > 1
+        self.dims = dims
+        self.growth = growth
+        self._buffer = np.empty((max(capacity, 1), dims), dtype=np.float32)
+        self._size = 0
+        self._offsets = [0]
+
+    def append(self, descriptors):
+        # images without keypoints get an empty row range
+        if descriptors is None:
+            descriptors = np.empty((0, self.dims), dtype=np.float32)
+        rows = len(descriptors)
+        self._reserve(self._size + rows)
+        self._buffer[self._size:self._size + rows] = descriptors
+        self._size += rows
+        self._offsets.append(self._size)
+
+    def _reserve(self, rows):
+        if rows <= len(self._buffer):
+            return
+        capacity = len(self._buffer)
+        while capacity < rows:
+            capacity = int(capacity * self.growth) + 1
+        buffer = np.empty((capacity, self.dims), dtype=np.float32)
+        buffer[:self._size] = self._buffer[:self._size]
+        self._buffer = buffer
+
+    @property
+    def descriptors(self):
+        """View of all stored descriptors, shape (total descriptors, dims)."""
+        return self._buffer[:self._size]
+
+    @property
+    def offsets(self):
+        return np.asarray(self._offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        return self._buffer[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -0,0 +1,143 @@
+import os
+import time
+import argparse
+import torch
+import torch.nn as nn
+from .feature_cache import hash_parts
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+def get_export_path(extractor_path, channels_last=False, quantized=False):
+    return extractor_path + '_exported' + ('_channels_last' if channels_last else '') + ('_int8' if quantized else '')
+
+def quantize_extractor(feature_extractor):
+    """Dynamic int8 quantization of the Linear layers, their weights are stored in int8 and activations are quantized per batch."""
+    feature_extractor.eval()
+    return torch.ao.quantization.quantize_dynamic(feature_extractor.cpu(), {nn.Linear}, dtype=torch.qint8)
+
+def get_export_key(extractor_path, key_parts, example_batch, channels_last=False):
+    # the export belongs to this version of the checkpoint, and the trace is specialised to the torch version,
+    # the input shape without the batch size and the memory format
+    stat = os.stat(extractor_path)
+    return hash_parts(key_parts, stat.st_size, stat.st_mtime_ns, torch.__version__, list(example_batch.shape[1:]), channels_last, str(device))
+
+def export_extractor(feature_extractor, example_batch, export_path, export_key, channels_last=False):
+    """Trace an eval mode feature extractor, freeze it and save it as TorchScript.
+
+    Freezing inlines the weights as constants and folds every batch norm into the convolution before it.
+
+    Args:
+        feature_extractor (nn.Module): The eager extractor, put in eval mode before tracing.
+        example_batch (Tensor): A preprocessed batch the extractor is traced with.
+        export_path (string): File to save the exported extractor to.
+        export_key (string): Saved with the extractor, load_exported_extractor only returns extractors with the same key.
+        channels_last (bool): Trace for channels last batches.
+    """
+    feature_extractor.eval()
+    feature_extractor.to(device)
+    example_batch = example_batch.to(device)
+    if channels_last:
+        feature_extractor = feature_extractor.to(memory_format=torch.channels_last)
+        example_batch = example_batch.contiguous(memory_format=torch.channels_last)
+    start = time.time()
+    with torch.no_grad():
+        traced = torch.jit.trace(feature_extractor, example_batch)
+        frozen = torch.jit.freeze(traced)
+    tmp_path = export_path + '.tmp'
+    torch.jit.save(frozen, tmp_path, _extra_files={'export_key': export_key})
+    os.replace(tmp_path, export_path)
+    print('Exported feature extractor to', export_path, 'in', time.time() - start, 's')
+    return frozen
+
+def load_exported_extractor(export_path, export_key=None):
+    """Load an exported extractor, None when there is none or it was exported with a different key."""
+    if not os.path.exists(export_path):
+        return None
+    extra_files = {'export_key': ''}
+    exported = torch.jit.load(export_path, map_location=device, _extra_files=extra_files)
+    saved_key = extra_files['export_key']
+    saved_key = saved_key.decode('utf-8') if isinstance(saved_key, bytes) else saved_key
+    if export_key is not None and saved_key != export_key:
+        print('Exported feature extractor', export_path, 'is out of date')
+        return None
+    print('Loaded exported feature extractor from', export_path)
+    return exported
+
+def get_exported_extractor(load_eager_extractor, example_batch, extractor_path, key_parts, channels_last=False, quantized=False):
+    """The exported extractor of a checkpoint, exported from load_eager_extractor() first when it is missing or out of date.
+
+    Args:
+        load_eager_extractor (callable): Returns the eager extractor of the checkpoint.
+        example_batch (Tensor): A preprocessed batch to trace with.
+        extractor_path (string): The checkpoint, the export is saved next to it.
+        key_parts (list): Describe the extractor, e.g. its architecture.
+        channels_last (bool): Export for channels last batches.
+        quantized (bool): Export the extractor with int8 Linear layers, see quantize_extractor.
+    """
+    export_path = get_export_path(extractor_path, channels_last, quantized)
+    export_key = get_export_key(extractor_path, key_parts + [quantized], example_batch, channels_last)
+    exported = load_exported_extractor(export_path, export_key)
+    if exported is None:
+        feature_extractor = load_eager_extractor()
+        if quantized:
+            feature_extractor = quantize_extractor(feature_extractor)
+        exported = export_extractor(feature_extractor, example_batch, export_path, export_key, channels_last)
+    return exported
+
+def benchmark_extractor(feature_extractor, batch, repeats=10):
+    """Return the latency of a single image in ms and the throughput of the batch in images/s."""
+    single = batch[:1]
+    with torch.inference_mode():
+        # warm up, TorchScript optimises the graph during the first calls
+        for _ in range(3):
+            feature_extractor(single)
+            feature_extractor(batch)
+        start = time.time()
+        for _ in range(repeats):
+            feature_extractor(single)
+        latency = (time.time() - start) / repeats * 1000
+        start = time.time()
+        for _ in range(repeats):
+            feature_extractor(batch)
+        throughput = repeats * len(batch) / (time.time() - start)
+    return latency, throughput
+
+def compare_extractors(eager_extractor, exported_extractor, batch, repeats=10):
+    """Print the latency, throughput and largest feature difference of the eager and the exported extractor."""
+    with torch.inference_mode():
+        difference = (eager_extractor(batch) - exported_extractor(batch)).abs().max().item()
+    for name, feature_extractor in [('eager', eager_extractor), ('exported', exported_extractor)]:
+        latency, throughput = benchmark_extractor(feature_extractor, batch, repeats)
+        print(name, 'latency', latency, 'ms per image, throughput', throughput, 'images/s with batches of', len(batch))
+    print('Largest difference between eager and exported features', difference)
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='Export a trained feature extractor and benchmark it against the eager extractor')
+    parser.add_argument("extractor_path", type=str, help="Checkpoint of the baseline CNN or transfer learned resnet")
+    parser.add_argument("-model", "--model-name", type=str, default="baseline", choices=["baseline", "resnet18", "resnet152"], help="Architecture of the checkpoint.")
+    parser.add_argument("-labels", "--label-amount", type=int, default=200, help="Amount of labels the resnet was transfer learned on.")
+    parser.add_argument("-g", "--grey", default=False, action="store_true", help="The baseline CNN was trained on grey images.")
+    parser.add_argument("-b", "--batch-size", default=32, type=int, help="Batch size of the throughput benchmark.")
+    parser.add_argument("-r", "--repeats", default=10, type=int, help="Amount of timed forward passes.")
+    parser.add_argument("-cl", "--channels-last", default=False, action="store_true", help="Export and benchmark for channels last batches.")
+    parser.add_argument("-int8", "--quantized", default=False, action="store_true", help="Export with dynamic int8 quantization of the Linear layers.")
+    return parser
+
+if __name__ == '__main__':
+    from .baseline_cnn_dataset import load_baseline_extractor
+    from .imagenet_pretrained import load_transfer_learned_extractor
+    args = get_argparser().parse_args()
+    channels = 1 if args.grey and args.model_name == 'baseline' else 3
+    batch = torch.rand(args.batch_size, channels, 256, 256).to(device)
+    if args.model_name == 'baseline':
+        load_eager_extractor = lambda: load_baseline_extractor(args.extractor_path, args.grey)
+        key_parts = ['baseline', args.grey]
+    else:
+        load_eager_extractor = lambda: load_transfer_learned_extractor(args.extractor_path, args.model_name, args.label_amount)
+        key_parts = [args.model_name, args.label_amount]
+    exported = get_exported_extractor(load_eager_extractor, batch, args.extractor_path, key_parts, args.channels_last, args.quantized)
+    eager = load_eager_extractor().to(device)
+    if args.channels_last:
+        eager = eager.to(memory_format=torch.channels_last)
+        batch = batch.contiguous(memory_format=torch.channels_last)
+    compare_extractors(eager, exported, batch, args.repeats)
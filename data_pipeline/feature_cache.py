@@ -0,0 +1,182 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from os import path
+import numpy as np
+from .feature_store import load_features, save_features
+
+MANIFEST_NAME = 'cache_manifest.json'
+
+# limits applied by every FeatureCache that is not given its own, None means no limit
+default_max_bytes = None
+default_max_entries = None
+
+def set_default_limits(max_bytes=None, max_entries=None):
+    global default_max_bytes, default_max_entries
+    default_max_bytes = max_bytes
+    default_max_entries = max_entries
+
+def hash_parts(*parts):
+    """Stable hash of JSON serialisable key parts."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def images_fingerprint(images, image_paths=None):
+    """Identify a list of images.
+
+    With the paths the images were read from, only the path, size and modification time of
+    every file is used, so nothing is decoded or hashed. Without paths the image bytes are hashed.
+    """
+    if image_paths is None:
+        # an ImageSource knows the paths of its images
+        image_paths = getattr(images, 'paths', None)
+    if image_paths is not None:
+        stats = [os.stat(image_path) for image_path in image_paths]
+        return hash_parts([[str(image_path), stat.st_size, stat.st_mtime_ns] for image_path, stat in zip(image_paths, stats)])
+    sha = hashlib.sha1()
+    for image in images:
+        image = np.ascontiguousarray(image)
+        sha.update(str(image.shape).encode('utf-8'))
+        sha.update(image.data)
+    return sha.hexdigest()
+
+class FeatureCache(object):
+    """Feature files in a folder keyed on a hash of everything they were built from.
+
+    A manifest in the folder records the name, size, creation and last use time of every entry.
+    When the cache grows past max_bytes or max_entries the least recently used entries are removed.
+
+    Args:
+        folder (string): Folder holding the cached files and the manifest.
+        max_bytes (int, optional): Size limit of all entries together.
+        max_entries (int, optional): Limit on the amount of entries.
+    """
+
+    def __init__(self, folder, max_bytes=None, max_entries=None):
+        self.folder = folder
+        self.max_bytes = max_bytes if max_bytes is not None else default_max_bytes
+        self.max_entries = max_entries if max_entries is not None else default_max_entries
+        self.manifest_path = path.join(folder, MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        if path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {'entries': {}, 'checksums': {}}
+
+    def _save_manifest(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def file_checksum(self, file_path):
+        """Checksum of a file such as a model checkpoint, only recomputed when the file changes."""
+        stat = os.stat(file_path)
+        fingerprint = hash_parts(path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+        checksum = self.manifest['checksums'].get(fingerprint)
+        if checksum is None:
+            sha = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            checksum = sha.hexdigest()
+            self.manifest['checksums'][fingerprint] = checksum
+            self._save_manifest()
+        return checksum
+
+    def get_key(self, name, key_parts):
+        return hash_parts(name, key_parts)
+
+    def get_path(self, name, key):
+        return path.join(self.folder, name + '_' + key[:16])
+
+    def load(self, name, key_parts, loader=load_features):
+        """Return the cached value for the key parts or None if there is none."""
+        key = self.get_key(name, key_parts)
+        entry = self.manifest['entries'].get(key)
+        if entry is None:
+            return None
+        file_path = path.join(self.folder, entry['file'])
+        if not path.exists(file_path):
+            del self.manifest['entries'][key]
+            self._save_manifest()
+            return None
+        print('Loading', name, 'from', file_path)
+        entry['last_used'] = time.time()
+        self._save_manifest()
+        return loader(file_path)
+
+    def latest(self, name, loader=load_features):
+        """Return the most recently created value with a name, for datasets built from other datasets."""
+        entries = [(key, entry) for key, entry in self.manifest['entries'].items() if entry['name'] == name]
+        if not entries:
+            return None, None
+        key, entry = max(entries, key=lambda item: item[1]['created'])
+        file_path = path.join(self.folder, entry['file'])
+        print('Loading', name, 'from', file_path)
+        entry['last_used'] = time.time()
+        self._save_manifest()
+        return key, loader(file_path)
+
+    def store(self, name, key_parts, value, writer=save_features):
+        key = self.get_key(name, key_parts)
+        file_path = self.get_path(name, key)
+        os.makedirs(self.folder, exist_ok=True)
+        # write to a temporary file first so an interrupted write never looks like a cached entry
+        tmp_path = file_path + '.tmp'
+        writer(value, tmp_path)
+        os.replace(tmp_path, file_path)
+        now = time.time()
+        self.manifest['entries'][key] = {
+            'name': name,
+            'file': path.basename(file_path),
+            'size': path.getsize(file_path),
+            'created': now,
+            'last_used': now,
+        }
+        print('Saving', name, 'to', file_path)
+        self.evict(keep=key)
+        self._save_manifest()
+        return key
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.manifest['entries'].values())
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache is within its limits."""
+        entries = sorted(self.manifest['entries'].items(), key=lambda item: item[1]['last_used'])
+        total = self.total_bytes()
+        for key, entry in entries:
+            over_bytes = self.max_bytes is not None and total > self.max_bytes
+            over_entries = self.max_entries is not None and len(self.manifest['entries']) > self.max_entries
+            if not (over_bytes or over_entries):
+                break
+            if key == keep:
+                continue
+            print('Evicting', entry['name'], 'from the feature cache')
+            file_path = path.join(self.folder, entry['file'])
+            if path.exists(file_path):
+                os.remove(file_path)
+            total -= entry['size']
+            del self.manifest['entries'][key]
+        self._save_manifest()
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='List or evict entries of a feature cache')
+    parser.add_argument("folder", type=str, help="The feature cache folder")
+    parser.add_argument("-gb", "--max-gb", type=float, default=None, help="Evict least recently used entries above this size in GB")
+    parser.add_argument("-n", "--max-entries", type=int, default=None, help="Evict least recently used entries above this amount")
+    return parser
+
+if __name__ == '__main__':
+    args = get_argparser().parse_args()
+    max_bytes = int(args.max_gb * 1e9) if args.max_gb is not None else None
+    cache = FeatureCache(args.folder, max_bytes, args.max_entries)
+    cache.evict()
+    for key, entry in sorted(cache.manifest['entries'].items(), key=lambda item: item[1]['last_used']):
+        print(entry['file'], entry['size'], time.ctime(entry['created']), time.ctime(entry['last_used']))
+    print('Total size', cache.total_bytes(), 'bytes')
@@ -0,0 +1,112 @@
+import os
+import time
+import pickle
+from os import path
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+from .feature_store import FeatureWriter, load_features
+
+# randomized fits a PCA on all training features with a randomized SVD, incremental fits on batches of them
+PROJECTION_SOLVERS = ['randomized', 'incremental']
+
+class FeatureProjection(object):
+    """PCA projection fitted once on the training features and applied to the features of any split in chunks.
+
+    Args:
+        reduced_dims (int): Amount of principal components kept.
+        solver (string): One of PROJECTION_SOLVERS.
+        batch_size (int): Amount of features in a partial_fit of the incremental solver and in a transformed chunk.
+        random_state (int): Seed of the randomized SVD.
+    """
+
+    def __init__(self, reduced_dims, solver='randomized', batch_size=4096, random_state=0):
+        if solver not in PROJECTION_SOLVERS:
+            raise ValueError('Please give a supported projection solver, one of ' + ', '.join(PROJECTION_SOLVERS))
+        self.reduced_dims = reduced_dims
+        self.solver = solver
+        # every batch of the incremental solver needs at least as many features as components
+        self.batch_size = max(batch_size, reduced_dims)
+        self.random_state = random_state
+        if solver == 'randomized':
+            self.pca = PCA(n_components=reduced_dims, svd_solver='randomized', random_state=random_state)
+        else:
+            self.pca = IncrementalPCA(n_components=reduced_dims, batch_size=self.batch_size)
+        self.fitted_on = 0
+
+    def partial_fit(self, features):
+        """Update the incremental solver with a batch of training features, e.g. as they are streamed from disk."""
+        if self.solver != 'incremental':
+            raise ValueError('Only the incremental solver can be fitted on batches')
+        self.pca.partial_fit(np.asarray(features, dtype=np.float32))
+        self.fitted_on += len(features)
+        return self
+
+    def fit(self, features):
+        start = time.time()
+        if self.solver == 'randomized':
+            self.pca.fit(np.asarray(features, dtype=np.float32))
+            self.fitted_on = len(features)
+        else:
+            # equal batches, so the last one is never smaller than the amount of components
+            batch_amount = max(1, len(features) // self.batch_size)
+            for rows in np.array_split(np.arange(len(features)), batch_amount):
+                self.partial_fit(features[rows[0]:rows[-1] + 1])
+        print('Fitted', self.solver, 'PCA projection to', self.reduced_dims, 'dimensions on', self.fitted_on, 'features in', time.time() - start, 's')
+        print('The projection keeps', self.pca.explained_variance_ratio_.sum(), 'of the variance')
+        return self
+
+    def transform(self, features):
+        """The projected features as float32, chunk by chunk so only a chunk of float64 intermediates is in memory."""
+        projected = np.empty((len(features), self.reduced_dims), dtype=np.float32)
+        for start in range(0, len(features), self.batch_size):
+            projected[start:start + self.batch_size] = self.pca.transform(np.asarray(features[start:start + self.batch_size]))
+        return projected
+
+    def write(self, features, file_path):
+        """Project the features chunk by chunk straight into a feature file, the projected features are never all in memory."""
+        writer = FeatureWriter(file_path, (len(features), self.reduced_dims), dtype=np.float32)
+        for start in range(0, len(features), self.batch_size):
+            writer[start:start + self.batch_size] = self.pca.transform(np.asarray(features[start:start + self.batch_size]))
+        writer.close()
+
+    def save(self, projection_path):
+        tmp_path = projection_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmp_path, projection_path)
+        print('Saving projection to', projection_path)
+
+def load_projection(projection_path):
+    with open(projection_path, 'rb') as f:
+        return pickle.load(f)
+
+def get_reduced_features(cache, features, reduced_name, key_parts, reduced_dims, projection_path, fit, solver='randomized'):
+    """The features projected to reduced_dims dimensions, from the cache when they were projected before.
+
+    Args:
+        cache (FeatureCache): Cache the reduced features are stored in.
+        key_parts (list): Identify the features that are reduced.
+        projection_path (string): File of the projection, shared by the training and test features.
+        fit (bool): Fit the projection on these features and save it, the training features. Otherwise the saved projection is applied.
+        solver (string): One of PROJECTION_SOLVERS.
+    """
+    if not fit and not path.exists(projection_path):
+        raise ValueError('Could not find the projection ' + projection_path + ', reduce the training features first')
+    # the projection checksum ties the reduced features to the projection they were made with
+    projection_checksum = cache.file_checksum(projection_path) if path.exists(projection_path) else None
+    reduced_key = key_parts + [reduced_dims, solver, projection_checksum]
+    reduced_features = cache.load(reduced_name, reduced_key)
+    if reduced_features is not None:
+        return reduced_features
+    if fit:
+        projection = FeatureProjection(reduced_dims, solver).fit(features)
+        projection.save(projection_path)
+        reduced_key = key_parts + [reduced_dims, solver, cache.file_checksum(projection_path)]
+    else:
+        projection = load_projection(projection_path)
+        if projection.reduced_dims != reduced_dims or projection.solver != solver:
+            raise ValueError('The projection ' + projection_path + ' was fitted with ' + str(projection.reduced_dims) + ' dimensions and the ' +
+                             projection.solver + ' solver')
+    print('Building reduced features of size', reduced_dims)
+    cache.store(reduced_name, reduced_key, features, writer=lambda features, file_path: projection.write(features, file_path))
+    return load_features(cache.get_path(reduced_name, cache.get_key(reduced_name, reduced_key)))
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import pickle
+from os import path
+import numpy as np
+import torch
+
+# a feature file is MAGIC, the length of the JSON header as 8 little endian bytes, the header
+# padded with spaces to a multiple of ALIGNMENT and then the raw row major feature matrix
+MAGIC = b'FEATSTOR'
+ALIGNMENT = 64
+FORMAT_VERSION = 1
+
+def _header_bytes(shape, dtype):
+    header = json.dumps({'version': FORMAT_VERSION, 'shape': list(shape), 'dtype': np.dtype(dtype).str}).encode('utf-8')
+    prefix_length = len(MAGIC) + 8
+    padding = -(prefix_length + len(header)) % ALIGNMENT
+    return header + b' ' * padding
+
+def is_feature_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_header(file_path):
+    """Return the header of a feature file and the byte offset of its matrix."""
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(file_path, 'is not a feature file, convert it with python -m data_pipeline.feature_store')
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    return header, len(MAGIC) + 8 + header_length
+
+class FeatureWriter(object):
+    """Write a feature matrix of known shape row by row into a feature file.
+
+    The matrix is a memory map of the file, so rows can be written as they are computed
+    without holding all features in memory.
+
+    Args:
+        file_path (string): Path of the feature file.
+        shape (tuple): Amount of rows and columns of the matrix.
+        dtype (numpy dtype): Type of the features.
+    """
+
+    def __init__(self, file_path, shape, dtype=np.float32):
+        header = _header_bytes(shape, dtype)
+        with open(file_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+        self.file_path = file_path
+        self.offset = len(MAGIC) + 8 + len(header)
+        if np.prod(shape) > 0:
+            self.features = np.memmap(file_path, dtype=dtype, mode='r+', offset=self.offset, shape=tuple(shape))
+        else:
+            self.features = np.empty(shape, dtype=dtype)
+
+    def __setitem__(self, idx, value):
+        self.features[idx] = value
+
+    def close(self):
+        if isinstance(self.features, np.memmap):
+            self.features.flush()
+        self.features = None
+
+def save_features(features, file_path):
+    features = np.ascontiguousarray(features)
+    # float64 from PCA and the like is stored as float32, other types are kept
+    if features.dtype == np.float64:
+        features = features.astype(np.float32)
+    if features.ndim == 1:
+        features = features[:, np.newaxis]
+    header = _header_bytes(features.shape, features.dtype)
+    with open(file_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(features.data)
+
+def load_features(file_path):
+    """Open a feature file as a memory mapped matrix, rows are only read from disk when used.
+
+    The map is copy on write, so rows can be handed to torch.from_numpy without a copy
+    and without the file ever being modified.
+    """
+    header, offset = read_header(file_path)
+    shape = tuple(header['shape'])
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=header['dtype'])
+    return np.memmap(file_path, dtype=header['dtype'], mode='c', offset=offset, shape=shape)
+
+def features_to_matrix(features):
+    """Convert features in one of the old formats, a list of (1, D) tensors or of vectors, to a matrix."""
+    if isinstance(features, np.ndarray):
+        return features
+    rows = [f.cpu().numpy() if torch.is_tensor(f) else np.asarray(f) for f in features]
+    if len(rows) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.concatenate([row.reshape(1, -1) for row in rows])
+
+def load_legacy_features(file_path):
+    # features were pickled by the SIFT datasets and saved with torch.save by the CNN datasets
+    try:
+        with open(file_path, 'rb') as f:
+            features = pickle.load(f)
+    except Exception:
+        features = torch.load(file_path, map_location=torch.device('cpu'))
+    return features_to_matrix(features)
+
+def convert_file(file_path, out_path=None):
+    """Convert a pickle or torch.save feature file to a feature file, in place without out_path."""
+    out_path = file_path if out_path is None else out_path
+    features = load_legacy_features(file_path)
+    tmp_path = out_path + '.tmp'
+    save_features(features, tmp_path)
+    os.replace(tmp_path, out_path)
+    print('Converted', file_path, 'to', out_path, 'with shape', features.shape)
+
+def convert_cache(folder):
+    """Convert every entry of the feature cache in a folder that is not a feature file yet."""
+    from .feature_cache import FeatureCache
+    cache = FeatureCache(folder)
+    for entry in cache.manifest['entries'].values():
+        file_path = path.join(folder, entry['file'])
+        if path.exists(file_path) and not is_feature_file(file_path):
+            convert_file(file_path)
+            entry['size'] = path.getsize(file_path)
+    cache._save_manifest()
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='Convert pickled or torch.save features to the memory mapped feature format')
+    parser.add_argument("paths", nargs='+', type=str, help="Feature cache folders, or single feature files to convert in place")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output path when converting a single file")
+    return parser
+
+if __name__ == '__main__':
+    args = get_argparser().parse_args()
+    for convert_path in args.paths:
+        if path.isdir(convert_path):
+            convert_cache(convert_path)
+        else:
+            convert_file(convert_path, args.output)
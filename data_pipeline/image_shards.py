@@ -0,0 +1,52 @@
+import os
+import time
+from os import path
+import numpy as np
+import pandas as pd
+import cv2 as cv
+from .image_source import ImageSource
+from .feature_store import FeatureWriter, load_features
+from .utils import get_image_paths, change_image_colourspace, fast_resize
+
+def get_shard_path(shard_folder, index_file, color_space=None, grey=False, size=256):
+    """Path of the shard of a split, e.g. <shard_folder>/Butterfly200_train_release_hsv_256."""
+    split_name = path.splitext(path.basename(index_file))[0]
+    colour_name = 'grey' if grey else (color_space if color_space is not None else 'original')
+    return path.join(shard_folder, split_name + '_' + colour_name + '_' + str(size))
+
+def get_labels_path(shard_path):
+    return shard_path + '_labels.npy'
+
+def prepare_image(image, color_space=None, grey=False, size=256):
+    # the same conversions ButterflyDataset applies, followed by a resize to size x size
+    if grey:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    elif color_space is not None:
+        image = change_image_colourspace(color_space, image)
+    return fast_resize(image, size)
+
+def build_image_shard(root_dir, index_file, shard_path, color_space=None, grey=False, size=256, prefetch=4):
+    """Decode, convert and resize every image of a split once and write them to a memory mapped uint8 shard.
+
+    The labels of every label index are written next to the shard, so one shard serves every label index.
+    """
+    indices = pd.read_csv(index_file, sep=' ', header=None)
+    images = ImageSource(get_image_paths(root_dir, indices), prefetch=prefetch)
+    shape = (len(images), size, size) if grey else (len(images), size, size, 3)
+    print('Building image shard of shape', shape, 'at', shard_path)
+    start = time.time()
+    tmp_path = shard_path + '.tmp'
+    writer = FeatureWriter(tmp_path, shape, dtype=np.uint8)
+    for i, image in enumerate(images):
+        writer[i] = prepare_image(image, color_space, grey, size)
+    writer.close()
+    np.save(get_labels_path(shard_path), indices.iloc[:, 1:].values.astype(np.int64))
+    # the shard only appears once it is complete
+    os.replace(tmp_path, shard_path)
+    print('Built shard of', len(images), 'images in', (time.time() - start)/60, 'minutes')
+
+def load_image_shard(shard_path):
+    """Return the memory mapped (N, size, size[, 3]) uint8 images and the (N, label indices) labels of a shard."""
+    images = load_features(shard_path)
+    labels = np.load(get_labels_path(shard_path), mmap_mode='r')
+    return images, labels
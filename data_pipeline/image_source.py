@@ -0,0 +1,58 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv
+from .utils import get_image_paths
+
+def read_image(image_path, grey=False):
+    image = cv.imread(image_path)
+    if image is None:
+        raise ValueError('Could not read image', image_path)
+    if grey:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    return image
+
+class ImageSource(object):
+    """Images that are only decoded when they are used, in place of a list of decoded images.
+
+    Iterating yields the images in order. With prefetch threads the next images are
+    decoded while the current one is processed, at most prefetch images ahead.
+
+    Args:
+        image_paths (list): Paths of the images.
+        grey (bool): Convert the images to grey scale.
+        prefetch (int): Amount of threads decoding images ahead of iteration, 0 decodes on demand.
+    """
+
+    def __init__(self, image_paths, grey=False, prefetch=0):
+        self.paths = list(image_paths)
+        self.grey = grey
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return ImageSource(self.paths[idx], self.grey, self.prefetch)
+        return read_image(self.paths[idx], self.grey)
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for image_path in self.paths:
+                yield read_image(image_path, self.grey)
+            return
+        # opencv releases the GIL while decoding, so threads decode in parallel
+        with ThreadPoolExecutor(self.prefetch) as executor:
+            pending = deque()
+            for image_path in self.paths:
+                pending.append(executor.submit(read_image, image_path, self.grey))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+def get_image_source(root_path, indices, N=None, grey=True, prefetch=0):
+    # lazy counterpart of utils.read_images
+    image_paths = get_image_paths(root_path, indices, N)
+    print('Using', len(image_paths), 'images from', root_path)
+    return ImageSource(image_paths, grey, prefetch)
@@ -6,60 +6,104 @@ import json
 from os import path
 import torch.nn as nn
 from PIL import Image
-from sklearn.decomposition import PCA
-from .utils import ToTensor, Rescale, Flatten
+from .utils import ToTensor, Rescale, Flatten, get_preprocess, report_preprocess_parity, get_feature_arrays
 from tqdm import tqdm
 import pickle
+from .feature_projection import get_reduced_features
+from .feature_cache import FeatureCache, images_fingerprint
+from .feature_store import features_to_matrix
+from .cnn_extraction import extract_features, check_batched_features
+from .exported_extractor import get_exported_extractor
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+def get_transfer_feature_extractor(model):
+    # the resnet up to and including fc, without the classification layer fc2
+    children = list(model.children())
+    feature_extractor = nn.Sequential(*list(children[:-2] + [Flatten()] + [children[-2]]))
+    return feature_extractor.eval()
+
+def load_transfer_learned_extractor(extractor_path, model_name, label_amount):
+    """The eager feature extractor of a transfer learned resnet checkpoint, in eval mode."""
+    feature_extractor = PretrainedImagenet.get_resnet_feature_extractor_for_transfer(model_name, label_amount)
+    if not path.exists(extractor_path):
+        ValueError('No feature extractor found trained with transfer learning. Please train the model.')
+    print('Found feature extractor trained with transfer learning')
+    checkpoint = torch.load(extractor_path, map_location=torch.device(device))
+    feature_extractor.load_state_dict(checkpoint['model_state_dict'])
+    feature_extractor.eval()
+    return feature_extractor
+
 class PretrainedImagenet(Dataset):
+    # increase when a change to this class changes the features it builds, so cached features are rebuilt
+    feature_version = 1
 
-    def __init__(self, images, labels, label_amount, feature_path, extractor_path, reduced_dims=None):
+    def __init__(self, images, labels, label_amount, feature_path, extractor_path, reduced_dims=None, image_paths=None,
+                 extraction_batch_size=32, extraction_workers=0, fast_preprocess=False, interpolation='auto', channels_last=False,
+                 exported=False, projection_path=None, projection_solver='randomized'):
         self.images = images
         self.labels = labels
         self.label_amount = label_amount
+        self.extraction_batch_size = extraction_batch_size
+        self.extraction_workers = extraction_workers
+        # opencv resizing in place of skimage, see utils.get_preprocess
+        self.fast_preprocess = fast_preprocess
+        self.interpolation = interpolation
+        self.channels_last = channels_last
+        # extract with the frozen TorchScript export of the extractor, see exported_extractor
+        self.exported = exported
         curr_dir = path.dirname(path.realpath(__file__))
         self.extractor_path = path.join(curr_dir, extractor_path)
         assert len(self.images) == len(self.labels)
-        full_feature_path = path.join(curr_dir, feature_path)
-        if path.exists(full_feature_path):
-            print('Loading pretrained Imagenet features from', full_feature_path)
-            self.features = torch.load(full_feature_path, map_location=device)
-        else:
+        feature_folder, feature_name = path.split(path.join(curr_dir, feature_path))
+        cache = FeatureCache(feature_folder)
+        # the checkpoint checksum ties the features to the extractor they were built with
+        extractor_checksum = cache.file_checksum(self.extractor_path) if path.exists(self.extractor_path) else None
+        cache_key = [self.feature_version, images_fingerprint(self.images, image_paths), extractor_checksum]
+        if fast_preprocess:
+            cache_key += ['opencv', interpolation]
+        if exported:
+            # folding the batch norm changes the rounding of the features
+            cache_key += ['exported']
+        self.features = cache.load(feature_name, cache_key)
+        if self.features is None:
             self.get_features_for_images()
-            print('Saving pretrained Imagenet features to', full_feature_path)
-            torch.save(self.features, full_feature_path)
-        # since the features come from a CNN they are batched tensors
-        self.features = [f[0].cpu().numpy() for f in self.features]
+            # the CNN gives a batched tensor per image, these are stored as one (N, D) matrix
+            self.features = features_to_matrix(self.features)
+            cache.store(feature_name, cache_key, self.features)
+        # the images are not needed once their features are built
+        self.images = None
+        # the test features are reduced with the projection of the training features, given by their dataset's projection_path
+        self.projection_path = projection_path
         if reduced_dims is not None:
-            reduced_features_path = path.join(curr_dir, feature_path + "_reduced_" + str(reduced_dims))
-            if path.exists(reduced_features_path):
-                print('Loading reduced imagened features from', reduced_features_path)
-                self.features = pickle.load(open(reduced_features_path, "rb"))            
-            else:
-                print('Building reduced features of size', reduced_dims)
-                pca = PCA(n_components=reduced_dims)
-                self.features = pca.fit_transform(self.features)
-                print('Saving reduced imagened features to', reduced_features_path)
-                pickle.dump(self.features, open(reduced_features_path, "wb"))
-
+            # without a projection path these are the training features, the projection is fitted on them and saved next to them
+            fit_projection = projection_path is None
+            if fit_projection:
+                self.projection_path = path.join(feature_folder, feature_name + '_projection_' + str(reduced_dims))
+            self.features = get_reduced_features(cache, self.features, feature_name + "_reduced_" + str(reduced_dims), cache_key, reduced_dims,
+                                                 self.projection_path, fit_projection, projection_solver)
 
     def get_features_for_images(self):
         preprocess = transforms.Compose([
-            Rescale(256),
-            ToTensor(grey=False),
+            get_preprocess(False, 256, self.fast_preprocess, self.interpolation, self.channels_last),
             # this is obligatory when using preatrained models from pytorch
             #transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
+        if self.fast_preprocess:
+            report_preprocess_parity(self.images, False, 256, self.interpolation)
         # enable GPU
-        model = self.load_transfer_learned_extractor()
-        children = list(model.children())
-        feature_extractor = nn.Sequential(*list(children[:-2] + [Flatten()] + [children[-2]]))
-        feature_extractor.to(device)
+        load_eager_extractor = lambda: get_transfer_feature_extractor(self.load_transfer_learned_extractor())
+        if self.exported:
+            example_batch = preprocess(self.images[0]).unsqueeze(0)
+            feature_extractor = get_exported_extractor(load_eager_extractor, example_batch, self.extractor_path,
+                                                       [self.get_model_name(), self.label_amount], self.channels_last)
+        else:
+            feature_extractor = load_eager_extractor()
+            feature_extractor.to(device)
         print('Getting imagenet features for', len(self.images), 'images')
-        with torch.no_grad():
-            self.features = [feature_extractor(preprocess(image).unsqueeze(0).to(device)) for image in tqdm(self.images)]
+        self.features = extract_features(feature_extractor, self.images, preprocess, device, self.extraction_batch_size, self.extraction_workers,
+                                         self.channels_last)
+        check_batched_features(feature_extractor, self.images, preprocess, device, self.features)
         print('Got features for images')
 
     def get_model_name(self):
@@ -70,15 +114,7 @@ class PretrainedImagenet(Dataset):
         raise ValueError('Please name extractor path with model architecture')
 
     def load_transfer_learned_extractor(self):
-        model_name = self.get_model_name()
-        feature_extractor = self.get_resnet_feature_extractor_for_transfer(model_name, self.label_amount)
-        if not path.exists(self.extractor_path):
-            ValueError('No feature extractor found trained with transfer learning. Please train the model.')
-        print('Found feature extractor trained with transfer learning')
-        checkpoint = torch.load(self.extractor_path, map_location=torch.device(device))
-        feature_extractor.load_state_dict(checkpoint['model_state_dict'])
-        feature_extractor.eval()
-        return feature_extractor
+        return load_transfer_learned_extractor(self.extractor_path, self.get_model_name(), self.label_amount)
 
     @classmethod
     def get_resnet_feature_extractor_for_transfer(self, model_name, labels_amount):
@@ -98,8 +134,12 @@ class PretrainedImagenet(Dataset):
         resnet.fc2 = nn.Linear(mid_features, labels_amount)
         return resnet
         
+    def as_arrays(self):
+        """The (N, D) features and (N,) labels, the features are not copied."""
+        return get_feature_arrays(self.features, self.labels)
+
     def __len__(self):
-        return len(self.images)
+        return len(self.features)
 
     def __getitem__(self, idx):
         return self.features[idx], self.labels[idx]
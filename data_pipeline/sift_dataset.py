@@ -6,62 +6,119 @@ import time
 from sklearn.cluster import MiniBatchKMeans
 import numpy as np
 import pickle
+from .sift_extraction import iter_sift, grey_descriptors
+from .descriptor_arena import DescriptorArena
+from .bow_encoding import encode_bow, encode_bow_stream
+from .vocabulary_tree import train_vocabulary_tree, get_vocabulary_name
+from .vocabulary import StreamingVocabularyTrainer, sample_descriptors
+from .feature_cache import FeatureCache, images_fingerprint
+from .utils import get_feature_arrays
 
 class SIFTDataset(Dataset):
+    # increase when a change to this class changes the features it builds, so cached features are rebuilt
+    feature_version = 1
 
-    def __init__(self, images, labels, feature_folder, vocabulary_size, test=False):
+    def __init__(self, images, labels, feature_folder, vocabulary_size, test=False, workers=1, chunk_size=16, streaming_batch_size=None,
+                 vocabulary_sample_size=None, sample_seed=0, normalisation='density', vocabulary_tree=None, image_paths=None):
         self.images = images
         self.labels = labels
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.streaming_batch_size = streaming_batch_size
+        self.vocabulary_sample_size = vocabulary_sample_size
+        self.sample_seed = sample_seed
+        self.normalisation = normalisation
+        # (branching, depth) of a hierarchical vocabulary used instead of flat k-means
+        self.vocabulary_tree = vocabulary_tree
         assert len(self.images) == len(self.labels)
         self.test = test
         test_id = '_test' if self.test else ''
-        full_feature_path = path.join(feature_folder, 'sift_features_grey_' + str(vocabulary_size) + test_id)
-        vocabulary_path = path.join(feature_folder, 'sift_vocabulary_' + str(vocabulary_size))
-        if path.exists(full_feature_path):
-            print('Loading SIFT features from', full_feature_path)
-            self.features = pickle.load(open(full_feature_path, "rb"))
-        else:
+        self.vocabulary_name = get_vocabulary_name(vocabulary_size, vocabulary_tree)
+        feature_name = 'sift_features_grey_' + self.vocabulary_name + test_id
+        vocabulary_path = path.join(feature_folder, 'sift_vocabulary_' + self.vocabulary_name)
+        cache = FeatureCache(feature_folder)
+        image_fingerprint = images_fingerprint(self.images, image_paths)
+        self.features = cache.load(feature_name, self.get_cache_key(cache, image_fingerprint, vocabulary_path))
+        if self.features is None:
+            # when streaming, descriptors are not kept in memory but extracted again for the histograms
+            arena = None
+            if self.streaming_batch_size is None:
+                arena = self.get_descriptor_arena(self.images)
             vocabulary = None
             if self.test:
                 vocabulary = pickle.load(open(vocabulary_path, 'rb'))
             else:
-                vocabulary = self.get_bow_vocabulary(self.images, vocabulary_size)
+                vocabulary = self.get_bow_vocabulary(arena, vocabulary_size)
                 print('Saving vocabulary to', vocabulary_path)
                 with open(vocabulary_path, 'wb') as f:
                     pickle.dump(vocabulary, f)
-            self.features = self.get_bow_features(self.images, vocabulary)
-            pickle.dump(self.features, open(full_feature_path, "wb"))
-            print('Saving SIFT features to', full_feature_path)
+            self.features = self.get_bow_features(arena, vocabulary)
+            cache.store(feature_name, self.get_cache_key(cache, image_fingerprint, vocabulary_path), self.features)
+        # the images are not needed once their features are built
+        self.images = None
 
-    def get_bow_vocabulary(self, images, vocabulary_size):
-        print('Building BOW vocabulary for', len(images), 'images')
+    def get_cache_key(self, cache, image_fingerprint, vocabulary_path):
+        # the vocabulary checksum ties the features to the vocabulary they were encoded with
+        vocabulary_checksum = cache.file_checksum(vocabulary_path) if path.exists(vocabulary_path) else None
+        return [self.feature_version, image_fingerprint, self.vocabulary_name, self.normalisation, self.test,
+                self.streaming_batch_size, self.vocabulary_sample_size, self.sample_seed, vocabulary_checksum]
+
+    def iter_descriptors(self, images):
+        return iter_sift(grey_descriptors, images, self.workers, self.chunk_size)
+
+    def get_descriptor_arena(self, images):
+        arena = DescriptorArena(128)
+        print('Getting descriptors for', len(images), 'images')
+        for desc in self.iter_descriptors(images):
+            arena.append(desc)
+        print('Got', len(arena.descriptors), 'descriptors')
+        return arena
+
+    def get_bow_vocabulary(self, arena, vocabulary_size):
+        print('Building BOW vocabulary for', len(self.images), 'images')
+        descriptors = [arena.descriptors] if arena is not None else self.iter_descriptors(self.images)
+        if self.vocabulary_sample_size is not None:
+            # the vocabulary is clustered from a sample, the histograms still use every descriptor
+            descriptors = [sample_descriptors(descriptors, self.vocabulary_sample_size, self.sample_seed)]
+        if self.vocabulary_tree is not None:
+            return self.get_vocabulary_tree(descriptors)
+        if self.streaming_batch_size is not None:
+            return self.get_streamed_bow_vocabulary(descriptors, vocabulary_size)
         bow_kmeans_trainer = cv.BOWKMeansTrainer(vocabulary_size)
-        sift = cv.xfeatures2d.SIFT_create()
-        descriptors = []
-        for image in images:
-            keypoints, desc = sift.detectAndCompute(image, None)
+        for desc in descriptors:
             bow_kmeans_trainer.add(desc)
-            descriptors += [desc]
-        print('Training Kmeans with size', vocabulary_size)
+        print('Training Kmeans with size', vocabulary_size, 'on', bow_kmeans_trainer.descriptorsCount(), 'descriptors')
         start = time.time()
         vocabulary = bow_kmeans_trainer.cluster()
         end = time.time()
         print('Training took', (end-start)/60, 'minutes')
         return vocabulary
 
-    def get_bow_features(self, images, vocabulary):
+    def get_vocabulary_tree(self, descriptors):
+        if not isinstance(descriptors, list):
+            raise ValueError('A vocabulary tree can not be trained from streamed descriptors, use a descriptor sample instead')
+        branching, depth = self.vocabulary_tree
+        return train_vocabulary_tree(descriptors[0], branching, depth)
+
+    def get_streamed_bow_vocabulary(self, descriptors, vocabulary_size):
+        print('Training streaming Kmeans with size', vocabulary_size)
+        trainer = StreamingVocabularyTrainer(vocabulary_size, self.streaming_batch_size)
+        for desc in descriptors:
+            trainer.add(desc)
+        kmeans = trainer.cluster()
+        # opencv expects the vocabulary as a float32 matrix
+        return kmeans.cluster_centers_.astype(np.float32)
+
+    def get_bow_features(self, arena, vocabulary):
         print('Getting BOW features')
-        sift = cv.xfeatures2d.SIFT_create()
-        extract = cv.xfeatures2d.SIFT_create()
-        flann_params = dict(algorithm = 1, trees = 5)
-        matcher = cv.FlannBasedMatcher(flann_params, {})
-        bow_extractor = cv.BOWImgDescriptorExtractor(extract, matcher)
-        bow_extractor.setVocabulary(vocabulary)
-        bow_features = []
-        for image in images:
-            features = bow_extractor.compute(image, sift.detect(image))
-            bow_features.append(features)
-        return bow_features
+        # the descriptors used for the vocabulary are reused, only streaming extracts them again
+        if arena is not None:
+            return encode_bow(arena.descriptors, arena.offsets, vocabulary, self.normalisation)
+        return encode_bow_stream(self.iter_descriptors(self.images), vocabulary, self.normalisation, self.streaming_batch_size)
+
+    def as_arrays(self):
+        """The (N, D) features and (N,) labels, the features are not copied."""
+        return get_feature_arrays(self.features, self.labels)
 
     def __len__(self):
         return len(self.features)
@@ -0,0 +1,67 @@
+import multiprocessing
+from functools import partial
+from itertools import islice
+import cv2 as cv
+import numpy as np
+from .utils import change_image_colourspace
+
+# every worker process creates its own SIFT instance, opencv objects can not be pickled
+_worker_sift = None
+
+def _init_sift_worker():
+    global _worker_sift
+    _worker_sift = cv.xfeatures2d.SIFT_create()
+
+def _apply_with_worker_sift(fn, item):
+    return fn(item, _worker_sift)
+
+def grey_descriptors(image, sift):
+    keypoints, desc = sift.detectAndCompute(image, None)
+    return desc
+
+def coloured_descriptors(images, sift):
+    # keypoints are found in the grey image and described in every colour dimension,
+    # the features from different image dimensions are concatenated together
+    image, grey_image = images
+    keypoints = sift.detect(grey_image)
+    concat_desc = None
+    for dim in range(3):
+        color_dim_image = image[:, :, dim]
+        keypoints, desc = sift.compute(color_dim_image, keypoints)
+        if concat_desc is None:
+            concat_desc = desc
+        else:
+            concat_desc = np.concatenate((concat_desc, desc), axis=1)
+    return concat_desc
+
+def colour_space_descriptors(color_space, image, sift):
+    # the conversions happen per image, so only one converted copy of an image exists at a time
+    grey_image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    return coloured_descriptors((change_image_colourspace(color_space, image), grey_image), sift)
+
+def iter_sift(fn, items, workers=1, chunk_size=16):
+    """Apply fn(item, sift) to every item and yield the results in the order of items.
+
+    Args:
+        fn (callable): Module level function taking an item and a SIFT instance.
+        items (iterable): The items to process, e.g. images.
+        workers (int): Amount of worker processes. With 1 or less everything runs in this process.
+        chunk_size (int): Amount of items sent to a worker at a time.
+    """
+    if workers is None or workers <= 1:
+        sift = cv.xfeatures2d.SIFT_create()
+        for item in items:
+            yield fn(item, sift)
+        return
+    items = iter(items)
+    # only a window of items is handed to the pool at a time, Pool.imap would otherwise
+    # consume the whole iterable up front and keep every item in memory
+    window = workers * chunk_size * 4
+    with multiprocessing.Pool(workers, initializer=_init_sift_worker) as pool:
+        worker_fn = partial(_apply_with_worker_sift, fn)
+        while True:
+            chunk = list(islice(items, window))
+            if not chunk:
+                break
+            for result in pool.imap(worker_fn, chunk, chunksize=chunk_size):
+                yield result
@@ -0,0 +1,62 @@
+import os
+from os import path
+import numpy as np
+import pandas as pd
+
+ARRAY_NAMES = ['paths_blob', 'path_offsets', 'labels']
+
+def get_compiled_folder(index_file):
+    return index_file + '_compiled'
+
+def compile_split_index(index_file, compiled_folder):
+    """Compile a split file into the arrays of a SplitIndex and save them as .npy files."""
+    indices = pd.read_csv(index_file, sep=' ', header=None)
+    encoded_paths = [str(image_path).encode('utf-8') for image_path in indices.iloc[:, 0]]
+    path_offsets = np.zeros(len(encoded_paths) + 1, dtype=np.int64)
+    path_offsets[1:] = np.cumsum([len(image_path) for image_path in encoded_paths])
+    paths_blob = np.frombuffer(b''.join(encoded_paths), dtype=np.uint8)
+    # one column per taxonomy level, the labels fit in int16
+    labels = indices.iloc[:, 1:].values.astype(np.int16)
+    os.makedirs(compiled_folder, exist_ok=True)
+    for name, array in zip(ARRAY_NAMES, [paths_blob, path_offsets, labels]):
+        tmp_path = path.join(compiled_folder, name + '.tmp.npy')
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path.join(compiled_folder, name + '.npy'))
+    print('Compiled', len(labels), 'split entries from', index_file, 'to', compiled_folder)
+
+class SplitIndex(object):
+    """Image paths and labels of a split in compact read only arrays.
+
+    The split file is compiled once into a bytes blob of all paths with their offsets and an
+    int16 matrix of the labels of every taxonomy level. The arrays are memory mapped, so forked
+    DataLoader workers share the same pages and lookups are plain array indexing.
+
+    Args:
+        index_file (string): The split file, an image path and the labels per line.
+        compiled_folder (string, optional): Folder for the compiled arrays, next to the split file by default.
+    """
+
+    def __init__(self, index_file, compiled_folder=None):
+        compiled_folder = compiled_folder if compiled_folder is not None else get_compiled_folder(index_file)
+        array_paths = [path.join(compiled_folder, name + '.npy') for name in ARRAY_NAMES]
+        # compile again when the split file changed after it was compiled
+        if not all(path.exists(array_path) and path.getmtime(array_path) >= path.getmtime(index_file) for array_path in array_paths):
+            compile_split_index(index_file, compiled_folder)
+        self.paths_blob, self.path_offsets, self.labels = [np.load(array_path, mmap_mode='r') for array_path in array_paths]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def image_path(self, idx):
+        return bytes(self.paths_blob[self.path_offsets[idx]:self.path_offsets[idx + 1]]).decode('utf-8')
+
+    def label(self, idx, label_i):
+        # label_i counts the columns of the split file, the first label column is 1
+        return int(self.labels[idx, label_i - 1])
+
+def load_species_names(species_file):
+    """Array of species names indexed by species id, a fixed width string array without Python objects per name."""
+    species = pd.read_csv(species_file, sep=' ', index_col=0, header=None)
+    names = np.full(species.index.max() + 1, '', dtype='<U' + str(species.iloc[:, 0].astype(str).str.len().max()))
+    names[species.index.values] = species.iloc[:, 0].astype(str).values
+    return names
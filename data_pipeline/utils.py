@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 import torch.nn as nn
 import matplotlib.pyplot as plt
+from torchvision import transforms
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -23,6 +24,11 @@ def read_images(root_path, indices, N=None, grey=True):
     print('Read', len(images), 'images')
     return images
 
+def get_image_paths(root_path, indices, N=None):
+    # the paths read_images reads from, used to identify the images in the feature cache
+    amount = len(indices) if N is None else min(N, len(indices))
+    return [os.path.join(root_path, indices.iloc[index, 0]) for index in range(amount)]
+
 # Rescale and ToTensor taken from this tutorial: 
 # https://pytorch.org/tutorials/beginner/data_loading_tutorial.html
 
@@ -60,6 +66,13 @@ class SampleRescale(object):
         img = transform.resize(image, (self.output_size, self.output_size))
         return img, label
 
+class SampleScale(object):
+    """Scale the uint8 image in a sample to floats in [0, 1], as SampleRescale outputs them."""
+
+    def __call__(self, sample):
+        image, label = sample
+        return (image / np.float32(255)), label
+
 class SampleToTensor(object):
     """Convert ndarrays in sample to Tensors."""
 
@@ -95,15 +108,125 @@ class ToTensor(object):
             image = np.array(image).transpose((2, 0, 1))
         return torch.from_numpy(image).float()
 
+INTERPOLATIONS = {
+    'nearest': cv.INTER_NEAREST,
+    'linear': cv.INTER_LINEAR,
+    'cubic': cv.INTER_CUBIC,
+    'area': cv.INTER_AREA,
+}
+
+def fast_resize(image, output_size, interpolation='auto'):
+    # opencv resizes uint8 images directly, auto is closest to skimage, which antialiases when
+    # shrinking and interpolates linearly when enlarging
+    if interpolation == 'auto':
+        shrinking = output_size <= min(image.shape[:2])
+        interpolation = 'area' if shrinking else 'linear'
+    return cv.resize(image, (output_size, output_size), interpolation=INTERPOLATIONS[interpolation])
+
+def to_float_tensor(image, grey, channels_last=False):
+    # a single conversion of a uint8 HWC image to a float32 CHW tensor in [0, 1]
+    image = np.multiply(image, np.float32(1 / 255), dtype=np.float32)
+    if grey:
+        return torch.from_numpy(image).unsqueeze(0)
+    if channels_last:
+        # a CHW view of the HWC data, so no transposed copy is made
+        return torch.from_numpy(image).permute(2, 0, 1)
+    return torch.from_numpy(np.ascontiguousarray(image.transpose((2, 0, 1))))
+
+class FastRescale(object):
+    """Resize a uint8 image to output_size x output_size with opencv, the fast counterpart of Rescale.
+
+    Args:
+        output_size (int): Width and height of the output.
+        interpolation (string): One of auto, nearest, linear, cubic or area.
+    """
+
+    def __init__(self, output_size, interpolation='auto'):
+        assert interpolation == 'auto' or interpolation in INTERPOLATIONS
+        self.output_size = output_size
+        self.interpolation = interpolation
+
+    def __call__(self, image):
+        return fast_resize(image, self.output_size, self.interpolation)
+
+class ToFloatTensor(object):
+    """Convert a uint8 image to a float32 CHW tensor in [0, 1], the fast counterpart of ToTensor after Rescale."""
+
+    def __init__(self, grey, channels_last=False):
+        self.grey = grey
+        self.channels_last = channels_last
+
+    def __call__(self, image):
+        return to_float_tensor(image, self.grey, self.channels_last)
+
+class SampleFastRescale(FastRescale):
+    """FastRescale for the image in a sample."""
+
+    def __call__(self, sample):
+        image, label = sample
+        return fast_resize(image, self.output_size, self.interpolation), label
+
+class SampleToFloatTensor(ToFloatTensor):
+    """ToFloatTensor for the image in a sample."""
+
+    def __call__(self, sample):
+        image, label = sample
+        # the dataset labels are indexed from one
+        return to_float_tensor(image, self.grey, self.channels_last), label - 1
+
+def get_preprocess(grey, output_size=256, fast=False, interpolation='auto', channels_last=False):
+    """The resize and tensor conversion of the CNN datasets, with skimage or with opencv when fast."""
+    if fast:
+        return transforms.Compose([FastRescale(output_size, interpolation), ToFloatTensor(grey, channels_last)])
+    return transforms.Compose([Rescale(output_size), ToTensor(grey)])
+
+def report_preprocess_parity(images, grey, output_size=256, interpolation='auto', amount=4):
+    """Print how far the fast preprocessing differs from the skimage preprocessing on the first images."""
+    reference = get_preprocess(grey, output_size)
+    fast = get_preprocess(grey, output_size, fast=True, interpolation=interpolation)
+    differences = []
+    for idx in range(min(amount, len(images))):
+        differences.append((reference(images[idx]) - fast(images[idx])).abs())
+    if not differences:
+        return
+    differences = torch.stack(differences)
+    print('Fast preprocessing with', interpolation, 'interpolation differs from skimage by at most',
+          differences.max().item(), 'and on average', differences.mean().item())
+
+class ChangeColourSpace(object):
+    """Convert a BGR image to another colour space, see change_image_colourspace."""
+
+    def __init__(self, color_space):
+        self.color_space = color_space
+
+    def __call__(self, image):
+        return change_image_colourspace(self.color_space, image)
+
+class ToGrey(object):
+    """Convert a BGR image to grey scale."""
+
+    def __call__(self, image):
+        return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+
+def get_feature_arrays(features, labels):
+    """Contiguous (N, D) features and (N,) labels as NumPy arrays, without copying arrays that already are."""
+    features = np.ascontiguousarray(features)
+    return features.reshape(len(features), -1), np.ascontiguousarray(labels).reshape(-1)
+
 def get_all_data_from_loader(dataloader):
-    features = torch.FloatTensor().to(device)
-    labels = torch.LongTensor().to(device)
+    # collect the batches and concatenate once, copying every batch once instead of once per later batch
+    features = []
+    labels = []
     for x, y in dataloader:
-        x = x.to(device)
-        y = y.to(device)
-        features = torch.cat((features, x.float()), 0)
-        labels = torch.cat((labels, y), 0)
-    return torch.squeeze(features).cpu().numpy(), torch.squeeze(labels).cpu().numpy()
+        features.append(x.float().numpy().reshape(len(x), -1))
+        labels.append(y.numpy().reshape(-1))
+    return np.concatenate(features), np.concatenate(labels)
+
+def get_dataset_arrays(dataloader):
+    """The features and labels of a dataloader's dataset, directly from the dataset when it has as_arrays."""
+    if hasattr(dataloader.dataset, 'as_arrays'):
+        return dataloader.dataset.as_arrays()
+    return get_all_data_from_loader(dataloader)
 
 def normalise_rgb_dims(image):
     # normalisation should reduce sensitivity to lumincance, surface orientation and other conditions
@@ -0,0 +1,107 @@
+import time
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+class StreamingVocabularyTrainer(object):
+    """Train a k-means vocabulary from descriptors as images are processed.
+
+    Descriptors are buffered until batch_size of them have been added and the buffer
+    is then passed to MiniBatchKMeans.partial_fit, so at most batch_size descriptors
+    are held in memory no matter how large the dataset is.
+
+    Args:
+        vocabulary_size (int): Amount of clusters in the vocabulary.
+        batch_size (int): Amount of descriptors in a partial_fit call, at least vocabulary_size.
+        random_state (int): Seed for the k-means initialisation.
+    """
+
+    def __init__(self, vocabulary_size, batch_size, random_state=0):
+        if batch_size < vocabulary_size:
+            raise ValueError('The streaming batch size needs to be at least the vocabulary size')
+        self.vocabulary_size = vocabulary_size
+        self.batch_size = batch_size
+        self.kmeans = MiniBatchKMeans(n_clusters=vocabulary_size, random_state=random_state)
+        self.descriptor_count = 0
+        self.training_time = 0
+        self._buffer = None
+        self._size = 0
+        self._fitted = False
+
+    def add(self, descriptors):
+        if descriptors is None:
+            return
+        if self._buffer is None:
+            self._buffer = np.empty((self.batch_size, descriptors.shape[1]), dtype=np.float32)
+        self.descriptor_count += len(descriptors)
+        while len(descriptors) > 0:
+            rows = min(len(descriptors), self.batch_size - self._size)
+            self._buffer[self._size:self._size + rows] = descriptors[:rows]
+            self._size += rows
+            descriptors = descriptors[rows:]
+            if self._size == self.batch_size:
+                self._partial_fit()
+
+    def _partial_fit(self):
+        start = time.time()
+        self.kmeans.partial_fit(self._buffer[:self._size])
+        self.training_time += time.time() - start
+        self._fitted = True
+        self._size = 0
+
+    def cluster(self):
+        """Fit the remaining buffered descriptors and return the trained MiniBatchKMeans."""
+        if self._size > 0 and (self._fitted or self._size >= self.vocabulary_size):
+            self._partial_fit()
+        if not self._fitted:
+            raise ValueError('Got', self.descriptor_count, 'descriptors, at least', self.vocabulary_size, 'are needed to train the vocabulary')
+        # the buffer is not needed after training
+        self._buffer = None
+        print('Trained vocabulary on', self.descriptor_count, 'descriptors in batches of', self.batch_size)
+        print('Training took', self.training_time/60, 'minutes')
+        return self.kmeans
+
+class DescriptorSampler(object):
+    """Uniform reservoir sample of a fixed amount of descriptors.
+
+    Args:
+        sample_size (int): The descriptor budget, at most this many descriptors are kept.
+        seed (int): Seed of the random generator, the same seed gives the same sample.
+    """
+
+    def __init__(self, sample_size, seed=0):
+        self.sample_size = sample_size
+        self.random = np.random.RandomState(seed)
+        self.seen = 0
+        self._reservoir = None
+        self._size = 0
+
+    def add(self, descriptors):
+        if descriptors is None or len(descriptors) == 0:
+            return
+        if self._reservoir is None:
+            self._reservoir = np.empty((self.sample_size, descriptors.shape[1]), dtype=np.float32)
+        # the reservoir is filled with the first descriptors
+        rows = min(len(descriptors), self.sample_size - self._size)
+        self._reservoir[self._size:self._size + rows] = descriptors[:rows]
+        self._size += rows
+        self.seen += rows
+        descriptors = descriptors[rows:]
+        if len(descriptors) == 0:
+            return
+        # after that the n-th descriptor replaces a random slot with probability sample_size / n
+        seen_counts = self.seen + np.arange(1, len(descriptors) + 1)
+        slots = (self.random.random_sample(len(descriptors)) * seen_counts).astype(np.int64)
+        replace = slots < self.sample_size
+        self._reservoir[slots[replace]] = descriptors[replace]
+        self.seen += len(descriptors)
+
+    def sample(self):
+        return self._reservoir[:self._size]
+
+def sample_descriptors(descriptors, sample_size, seed=0):
+    """Reservoir sample sample_size descriptors from an iterable of descriptor matrices."""
+    sampler = DescriptorSampler(sample_size, seed)
+    for desc in descriptors:
+        sampler.add(desc)
+    print('Sampled', len(sampler.sample()), 'of', sampler.seen, 'descriptors for the vocabulary')
+    return sampler.sample()
@@ -0,0 +1,115 @@
+import time
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from .bow_encoding import assign_words
+
+class VocabularyTree(object):
+    """Hierarchical k-means vocabulary with branching ** depth words.
+
+    Every node is split into branching children with k-means on the descriptors
+    that reached it. A descriptor is assigned to a word by descending the tree,
+    which costs O(branching * depth) distance computations instead of O(words).
+
+    Args:
+        branching (int): Amount of children of every node.
+        depth (int): Amount of levels below the root, the leaves are the words.
+        random_state (int): Seed for the k-means of every node.
+    """
+
+    def __init__(self, branching, depth, random_state=0):
+        assert branching > 1 and depth > 0
+        self.branching = branching
+        self.depth = depth
+        self.random_state = random_state
+        # centres[level] holds the centres of every node at depth level + 1,
+        # the children of node n at a level are the nodes n * branching ... (n + 1) * branching - 1
+        self.centres = []
+
+    def __len__(self):
+        return self.branching ** self.depth
+
+    @property
+    def dims(self):
+        return self.centres[-1].shape[1]
+
+    @property
+    def leaf_centres(self):
+        return self.centres[-1]
+
+    def fit(self, descriptors):
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        self.centres = []
+        node_ids = np.zeros(len(descriptors), dtype=np.int64)
+        parent_centres = descriptors.mean(axis=0, keepdims=True)
+        for level in range(self.depth):
+            node_amount = self.branching ** level
+            level_centres = np.empty((node_amount * self.branching, descriptors.shape[1]), dtype=np.float32)
+            child_ids = np.empty_like(node_ids)
+            # group descriptor indices by the node they reached
+            order = np.argsort(node_ids, kind='stable')
+            counts = np.bincount(node_ids, minlength=node_amount)
+            ends = np.cumsum(counts)
+            starts = ends - counts
+            for node in range(node_amount):
+                members = order[starts[node]:ends[node]]
+                node_centres = self._split_node(descriptors[members], parent_centres[node])
+                level_centres[node * self.branching:(node + 1) * self.branching] = node_centres
+                if len(members) > 0:
+                    child_ids[members] = node * self.branching + assign_words(descriptors[members], node_centres)
+            self.centres.append(level_centres)
+            parent_centres = level_centres
+            node_ids = child_ids
+        return self
+
+    def _split_node(self, descriptors, parent_centre):
+        unique = np.unique(descriptors, axis=0) if len(descriptors) > 0 else descriptors
+        if len(unique) >= self.branching:
+            kmeans = MiniBatchKMeans(n_clusters=self.branching, random_state=self.random_state)
+            return kmeans.fit(descriptors).cluster_centers_
+        # nodes with too few distinct descriptors use them as centres and fill the rest with
+        # the parent centre, ties go to the first copy so the other copies stay empty
+        centres = np.repeat(parent_centre[np.newaxis], self.branching, axis=0)
+        centres[:len(unique)] = unique
+        return centres
+
+    def predict(self, descriptors, chunk_size=1024):
+        words = np.empty(len(descriptors), dtype=np.int64)
+        norms = [(level_centres ** 2).sum(axis=1) for level_centres in self.centres]
+        for start in range(0, len(descriptors), chunk_size):
+            chunk = np.asarray(descriptors[start:start + chunk_size], dtype=np.float32)
+            nodes = np.zeros(len(chunk), dtype=np.int64)
+            for level_centres, level_norms in zip(self.centres, norms):
+                children = nodes[:, np.newaxis] * self.branching + np.arange(self.branching)
+                # |x - c|^2 without the |x|^2 term, which is the same for every child
+                distances = level_norms[children] - 2 * np.einsum('nd,nbd->nb', chunk, level_centres[children])
+                nodes = children[np.arange(len(chunk)), distances.argmin(axis=1)]
+            words[start:start + chunk_size] = nodes
+        return words
+
+def report_tree_assignment(tree, descriptors):
+    """Compare descending the tree with exact nearest word search over the tree's leaves."""
+    start = time.time()
+    tree_words = tree.predict(descriptors)
+    tree_time = time.time() - start
+    start = time.time()
+    flat_words = assign_words(descriptors, tree.leaf_centres)
+    flat_time = time.time() - start
+    print('Assigning', len(descriptors), 'descriptors took', tree_time, 's with the tree and', flat_time, 's with flat search')
+    print('Tree speedup', flat_time / max(tree_time, 1e-9), 'agreement with flat search', (tree_words == flat_words).mean())
+
+def train_vocabulary_tree(descriptors, branching, depth, random_state=0, report_size=10000):
+    print('Training vocabulary tree with branching', branching, 'and depth', depth, 'on', len(descriptors), 'descriptors')
+    start = time.time()
+    tree = VocabularyTree(branching, depth, random_state).fit(descriptors)
+    end = time.time()
+    print('Training took', (end-start)/60, 'minutes')
+    step = max(1, len(descriptors) // report_size)
+    report_tree_assignment(tree, descriptors[::step])
+    return tree
+
+def get_vocabulary_name(vocabulary_size, vocabulary_tree=None):
+    # used in the file names of vocabularies and features
+    if vocabulary_tree is None:
+        return str(vocabulary_size)
+    branching, depth = vocabulary_tree
+    return 'tree_' + str(branching) + '_' + str(depth)
@@ -22,7 +22,8 @@ class BaselineCNN(nn.Module):
     def forward(self, x):
         x = self.pool1(F.relu(self.bn2d(self.conv1(x))))
         x = self.pool2(F.relu(self.conv2(x)))
-        x = x.view(-1, self.flattened_size)
+        # reshape rather than view, so channels last activations are flattened in the same order
+        x = x.reshape(-1, self.flattened_size)
         x = F.relu(self.fc1(x))
         x = F.relu(self.drop(self.fc2(x)))
         x = F.relu(self.fc3(x))
@@ -1,17 +1,31 @@
 import sys
 sys.path.append('./')
 
+import os
 import copy
 import argparse
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.optim as optim
 import torch.nn as nn
 from sklearn.model_selection import GridSearchCV
 from skorch import NeuralNetClassifier
 from torch.optim import lr_scheduler
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
 
 from models.baseline_cnn import BaselineCNN
 from data_pipeline.imagenet_pretrained import PretrainedImagenet
+from data_pipeline.feature_cache import FeatureCache
+from data_pipeline.utils import Flatten
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -20,64 +34,211 @@ def save_model(model, path):
     full_model_path = os.path.join(curr_dir, path)
     torch.save(model, full_model_path)
 
-def save_checkpoint(model, epoch, optimiser, model_filepath):
+def get_checkpoint(model, epoch, optimiser):
+    return {
+            'epoch': epoch,
+            'model_state_dict': model.state_dict(),
+            'optimiser_state_dict': optimiser.state_dict(),
+            }
+
+def snapshot(value):
+    # a copy on the CPU of every tensor, so training can keep updating the originals while the copy is written
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return copy.deepcopy(value)
+
+def write_checkpoint(checkpoint, model_filepath, keep=1):
+    """Write a checkpoint atomically and keep the keep - 1 previous ones as model_filepath.1, .2, ...
+
+    The checkpoint is written to a temporary file and renamed over model_filepath once it is on disk,
+    so a crash while writing leaves the previous checkpoint intact.
+    """
+    tmp_path = model_filepath + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    for i in range(keep - 1, 1, -1):
+        if os.path.exists(model_filepath + '.' + str(i - 1)):
+            os.replace(model_filepath + '.' + str(i - 1), model_filepath + '.' + str(i))
+    if keep > 1 and os.path.exists(model_filepath):
+        # a hard link keeps the current checkpoint at model_filepath until the new one replaces it
+        link_path = model_filepath + '.link'
+        if os.path.exists(link_path):
+            os.remove(link_path)
+        os.link(model_filepath, link_path)
+        os.replace(link_path, model_filepath + '.1')
+    os.replace(tmp_path, model_filepath)
+
+def save_checkpoint(model, epoch, optimiser, model_filepath, keep=1):
     print('Saving model to', model_filepath)
-    torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimiser_state_dict': optimiser.state_dict(),
-                }, model_filepath)
+    write_checkpoint(get_checkpoint(model, epoch, optimiser), model_filepath, keep)
+
+class CheckpointWriter(object):
+    """Writes checkpoints in a background thread, so training does not wait for the disk.
+
+    save takes a CPU snapshot of the model and optimiser and returns, the thread writes it with write_checkpoint.
+    When a newer checkpoint is saved before an older one is written, only the newer one is written.
+
+    Args:
+        keep (int): Amount of checkpoints kept, the latest at model_filepath and the previous ones numbered.
+    """
+
+    def __init__(self, keep=1):
+        self.keep = keep
+        self.pending = None
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.write_pending, daemon=True)
+        self.thread.start()
+
+    def save(self, model, epoch, optimiser, model_filepath):
+        self.raise_error()
+        print('Saving model to', model_filepath)
+        checkpoint = snapshot(get_checkpoint(model, epoch, optimiser))
+        with self.condition:
+            self.pending = (checkpoint, model_filepath)
+            self.condition.notify()
+
+    def write_pending(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                checkpoint, model_filepath = self.pending
+                self.pending = None
+            start = time.time()
+            try:
+                write_checkpoint(checkpoint, model_filepath, self.keep)
+            except Exception as e:
+                self.error = e
+                return
+            print('Wrote checkpoint', model_filepath, 'in', time.time() - start, 's')
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Writing a checkpoint failed') from self.error
+
+    def close(self):
+        """Wait until the last saved checkpoint is written."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.raise_error()
 
-def train_neural_net(model, model_filepath, trainloader, evalloader, criterion, optimiser, scheduler, epochs=20, resume=True):
+def to_device(x, channels_last=False):
+    x = x.to(device)
+    # channels last only applies to image batches, not to embeddings
+    if channels_last and x.dim() == 4:
+        x = x.contiguous(memory_format=torch.channels_last)
+    return x
+
+def train_neural_net(model, model_filepath, trainloader, evalloader, criterion, optimiser, scheduler, epochs=20, resume=True, checkpoint_model=None,
+                     mixed_precision=False, channels_last=False, accuracy_tolerance=0.01, keep_checkpoints=1):
+    """Train a model and checkpoint it whenever its evaluation accuracy improves.
+
+    In a process of train_distributed the model is wrapped in DistributedDataParallel, then only rank 0
+    evaluates, prints and checkpoints, the other ranks wait for it after every epoch.
+
+    Args:
+        mixed_precision (bool): Run forward passes in bfloat16 autocast on the CPU, the loss is computed in float32.
+        channels_last (bool): Use the channels last memory format for the model and image batches.
+        accuracy_tolerance (float): With mixed precision, every evaluation is repeated in float32 and training continues
+            in float32 when the bfloat16 accuracy is lower by more than this.
+        keep_checkpoints (int): Amount of checkpoints kept, they are written in the background.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    # evaluation runs on the wrapped module, so it does not take part in the gradient synchronisation
+    eval_model = model.module if isinstance(model, DistributedDataParallel) else model
+    # checkpoint_model is saved instead of model, e.g. the whole network when only its head is trained
+    checkpoint_model = checkpoint_model if checkpoint_model is not None else eval_model
     # GPU Stuff
     epoch = 0
     print_interval = 50
     if resume:
+        # every rank loads the checkpoint, so all of them start from the same weights and optimiser state
         print('Loading checkpoint from', model_filepath)
         checkpoint = torch.load(model_filepath, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        checkpoint_model.load_state_dict(checkpoint['model_state_dict'])
         optimiser.load_state_dict(checkpoint['optimiser_state_dict'])
         epoch = checkpoint['epoch']
     model.to(device)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
     best_accuracy = 0
-    best_model = copy.deepcopy(model.state_dict())
-    print('Training a neural network with a trainset of size', len(trainloader.dataset))
+    if rank == 0:
+        print('Training a neural network with a trainset of size', len(trainloader.dataset))
+        checkpoint_writer = CheckpointWriter(keep_checkpoints)
     for _ in range(epochs):  # loop over the dataset multiple times
+        if isinstance(trainloader.sampler, DistributedSampler):
+            # a different shuffle every epoch
+            trainloader.sampler.set_epoch(epoch)
         running_loss = 0.0
         model.train()
+        start = time.time()
         for i, data in enumerate(trainloader):
-            inputs, labels = data[0].to(device), data[1].to(device)
+            inputs, labels = to_device(data[0], channels_last), data[1].to(device)
             optimiser.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=mixed_precision):
+                outputs = model(inputs)
+            # bfloat16 has the range of float32 so no loss scaling is needed, but the loss itself is computed in float32
+            loss = criterion(outputs.float(), labels)
             loss.backward()
             optimiser.step()
             running_loss += loss.item()
-            if (i+1) % print_interval == 0:
+            if (i+1) % print_interval == 0 and rank == 0:
                 print('[%d, %5d] loss: %.3f' %
                     (epoch + 1, i + 1, running_loss / print_interval))
                 running_loss = 0.0
+        duration = time.time() - start
         scheduler.step()
-        # evaluate after each epoch
-        print('Evaluating model')
-        model.eval()
-        with torch.no_grad():
-            loss, acc = evaluate_model_accuracy(model, evalloader, criterion)
-        print('Evaluation loss', loss, 'evaluation accuracy', acc)
-        if acc > best_accuracy:
-            print('New best accuracy')
-            best_model = copy.deepcopy(model.state_dict())
-            best_accuracy = acc
-            save_checkpoint(model, epoch, optimiser, model_filepath)
+        if rank == 0:
+            # the ranks train on their parts of the trainset at the same time
+            print('Epoch', epoch + 1, 'trained on', len(trainloader.dataset) / max(duration, 1e-9), 'samples/s')
+            # evaluate after each epoch
+            print('Evaluating model')
+            eval_model.eval()
+            with torch.no_grad():
+                loss, acc = evaluate_model_accuracy(eval_model, evalloader, criterion, mixed_precision, channels_last)
+                if mixed_precision:
+                    full_loss, full_acc = evaluate_model_accuracy(eval_model, evalloader, criterion, channels_last=channels_last)
+                    print('Float32 evaluation accuracy', full_acc, 'bfloat16 evaluation accuracy', acc)
+                    if full_acc - acc > accuracy_tolerance:
+                        print('bfloat16 accuracy is more than', accuracy_tolerance, 'below float32, continuing in float32')
+                        mixed_precision = False
+                    loss, acc = full_loss, full_acc
+            print('Evaluation loss', loss, 'evaluation accuracy', acc)
+            if acc > best_accuracy:
+                print('New best accuracy')
+                best_accuracy = acc
+                checkpoint_writer.save(checkpoint_model, epoch, optimiser, model_filepath)
+        if distributed:
+            # the other ranks follow the precision rank 0 decided on and wait until it evaluated
+            decision = [mixed_precision]
+            dist.broadcast_object_list(decision, src=0)
+            mixed_precision = decision[0]
         epoch += 1
+    if rank == 0:
+        checkpoint_writer.close()
 
-def evaluate_model_accuracy(model, evalloader, criterion):
+def evaluate_model_accuracy(model, evalloader, criterion, mixed_precision=False, channels_last=False):
     acc = 0
     loss = 0
     for x, y in evalloader:
-        x = x.to(device)
+        x = to_device(x, channels_last)
         y = y.to(device)
-        outputs = model(x)
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=mixed_precision):
+            outputs = model(x)
+        outputs = outputs.float()
         preds = torch.argmax(outputs, axis=1)
         acc += (y == preds).sum().item()
         loss += criterion(outputs, y).item()
@@ -85,19 +246,128 @@ def evaluate_model_accuracy(model, evalloader, criterion):
     loss /=  len(evalloader)
     return loss, acc
 
-def train_classifier(neural_net, params, model_path, trainloader, evalloader, resume, epochs):
+def get_distributed_loader(dataloader, rank, world_size):
+    """The dataloader with a DistributedSampler, so every rank trains on its own part of the dataset."""
+    sampler = DistributedSampler(dataloader.dataset, num_replicas=world_size, rank=rank,
+                                 shuffle=not isinstance(dataloader.sampler, torch.utils.data.SequentialSampler))
+    return DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, sampler=sampler, num_workers=dataloader.num_workers)
+
+def distributed_worker(rank, world_size, init_file, model, model_filepath, trainloader, evalloader, criterion, optimiser, scheduler, training_options):
+    # the cores are split between the processes, oversubscribing them makes every process slower
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    try:
+        training_options = dict(training_options)
+        checkpoint_model = training_options.pop('checkpoint_model', None)
+        checkpoint_model = checkpoint_model if checkpoint_model is not None else model
+        if training_options.get('channels_last', False):
+            # the memory format has to be set before DistributedDataParallel sets up its gradient buckets
+            model.to(memory_format=torch.channels_last)
+        # the model is copied into every process on fork, DistributedDataParallel all-reduces the gradients,
+        # with a static graph it also handles the unused fc2 of the transfer learning resnets
+        train_neural_net(DistributedDataParallel(model, static_graph=True), model_filepath, get_distributed_loader(trainloader, rank, world_size), evalloader,
+                         criterion, optimiser, scheduler, checkpoint_model=checkpoint_model, **training_options)
+    finally:
+        dist.destroy_process_group()
+
+def train_distributed(processes, model, model_filepath, trainloader, evalloader, criterion, optimiser, scheduler, **training_options):
+    """train_neural_net in processes forked on this host, data parallel with the gloo backend.
+
+    The processes meet through a file in a temporary folder, so no network services are needed.
+    Rank 0 evaluates and checkpoints exactly like train_neural_net, so resume works the same.
+    """
+    init_folder = tempfile.mkdtemp(prefix='distributed_init_')
+    try:
+        print('Training in', processes, 'processes')
+        mp.start_processes(distributed_worker, nprocs=processes, start_method='fork',
+                           args=(processes, os.path.join(init_folder, 'store'), model, model_filepath, trainloader, evalloader,
+                                 criterion, optimiser, scheduler, training_options))
+    finally:
+        shutil.rmtree(init_folder, ignore_errors=True)
+
+def train_classifier(neural_net, params, model_path, trainloader, evalloader, resume, epochs, checkpoint_model=None, processes=1, **training_options):
+    # training_options are mixed_precision, channels_last, accuracy_tolerance and keep_checkpoints of train_neural_net
     criterion = nn.CrossEntropyLoss()
     optimiser = optim.SGD(params, lr=0.01, momentum=0.9)
     scheduler = lr_scheduler.StepLR(optimiser, step_size=5, gamma=0.1)
+    if processes > 1:
+        train_distributed(processes, neural_net, model_path, trainloader, evalloader, criterion, optimiser, scheduler, epochs=epochs, resume=resume,
+                          checkpoint_model=checkpoint_model, **training_options)
+        return
     train_neural_net(neural_net, model_path, trainloader, \
-                        evalloader, criterion, optimiser, scheduler, epochs=epochs, resume=resume)
+                        evalloader, criterion, optimiser, scheduler, epochs=epochs, resume=resume, checkpoint_model=checkpoint_model,
+                        **training_options)
+
+def get_backbone(resnet):
+    # everything up to and including the pooling, the same layers PretrainedImagenet extracts features with
+    children = list(resnet.children())
+    return nn.Sequential(*list(children[:-2] + [Flatten()]))
+
+def get_model_checksum(model):
+    # the pretrained weights can change between torchvision versions, so they are part of the cache key
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+def get_dataset_key(dataset):
+    # identifies the samples of a ButterflyDataset, its split, images and transforms
+    split_hash = hashlib.sha1(np.asarray(dataset.indices.paths_blob).tobytes() + np.asarray(dataset.indices.labels).tobytes()).hexdigest()
+    sample_transforms = dataset.transform.transforms if dataset.transform is not None else []
+    return [split_hash, dataset.root_dir, dataset.grey, dataset.color_space, len(dataset), dataset.shard_images is not None,
+            [[type(t).__name__, vars(t)] for t in sample_transforms]]
+
+def compute_embeddings(backbone, dataloader):
+    """Pooled backbone activations of every sample of a dataloader, in the order of its dataset."""
+    loader = DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, shuffle=False, num_workers=dataloader.num_workers)
+    backbone.to(device)
+    backbone.eval()
+    embeddings = None
+    labels = np.empty(len(loader.dataset), dtype=np.int64)
+    row = 0
+    start = time.time()
+    with torch.no_grad():
+        for x, y in loader:
+            batch_embeddings = backbone(x.to(device)).cpu().numpy()
+            if embeddings is None:
+                embeddings = np.empty((len(loader.dataset), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[row:row + len(x)] = batch_embeddings
+            labels[row:row + len(x)] = y.numpy()
+            row += len(x)
+    print('Computed embeddings for', row, 'images in', (time.time() - start)/60, 'minutes')
+    return embeddings, labels
+
+def get_embedding_loader(backbone, dataloader, cache, name, key_parts, shuffle):
+    """A dataloader of (embedding, label) pairs, with the embeddings and labels computed once and cached."""
+    key_parts = key_parts + get_dataset_key(dataloader.dataset)
+    embeddings = cache.load(name, key_parts)
+    labels = cache.load(name + '_labels', key_parts)
+    if embeddings is None or labels is None:
+        embeddings, labels = compute_embeddings(backbone, dataloader)
+        cache.store(name, key_parts, embeddings)
+        cache.store(name + '_labels', key_parts, labels)
+    dataset = TensorDataset(torch.from_numpy(np.asarray(embeddings)), torch.from_numpy(np.asarray(labels)).reshape(-1))
+    return DataLoader(dataset, batch_size=dataloader.batch_size, shuffle=shuffle)
 
-def run_transfer_learning(model_name, checkpoint_path, trainloader, evalloader, last_layer_size, resume, epochs):
+def run_transfer_learning(model_name, checkpoint_path, trainloader, evalloader, last_layer_size, resume, epochs, embedding_folder=None, **training_options):
     neural_net = PretrainedImagenet.get_resnet_feature_extractor_for_transfer(model_name, last_layer_size)
     neural_net.to(device)
-    train_classifier(neural_net, list(neural_net.fc.parameters()) + list(neural_net.fc2.parameters()), checkpoint_path + '_' + model_name, trainloader, evalloader, resume, epochs)
+    params = list(neural_net.fc.parameters()) + list(neural_net.fc2.parameters())
+    if embedding_folder is None:
+        train_classifier(neural_net, params, checkpoint_path + '_' + model_name, trainloader, evalloader, resume, epochs, **training_options)
+        return
+    # the backbone is frozen, so its activations are computed once and only the head is trained on them,
+    # the head is fc since the resnet forward pass does not use fc2
+    cache = FeatureCache(embedding_folder)
+    backbone = get_backbone(neural_net)
+    backbone_key = [model_name, get_model_checksum(backbone)]
+    train_embeddings = get_embedding_loader(backbone, trainloader, cache, 'embeddings_' + model_name + '_train', backbone_key, shuffle=True)
+    eval_embeddings = get_embedding_loader(backbone, evalloader, cache, 'embeddings_' + model_name + '_eval', backbone_key, shuffle=False)
+    train_classifier(neural_net.fc, params, checkpoint_path + '_' + model_name, train_embeddings, eval_embeddings, resume, epochs,
+                     checkpoint_model=neural_net, **training_options)
 
-def run_baseline_training(neural_net, checkpoint_path, trainloader, evalloader, resume, epochs):
+def run_baseline_training(neural_net, checkpoint_path, trainloader, evalloader, resume, epochs, **training_options):
     neural_net.to(device)
-    train_classifier(neural_net, neural_net.parameters(), checkpoint_path, trainloader, evalloader, resume, epochs)
+    train_classifier(neural_net, neural_net.parameters(), checkpoint_path, trainloader, evalloader, resume, epochs, **training_options)
 
@@ -30,6 +30,16 @@ def get_argparser():
     parser.add_argument("-e", "--epochs", default=15, type=int, help="Number of training epochs.")
     parser.add_argument("-r", "--resume", default=False, action="store_true", help="If training should be resumed from model checkpoint.")
     parser.add_argument("-check", "--model-checkpoint", type=str, default="data_pipeline/saved_models/transfer_learning_checkpoint", help="Model checkpoint.")
+    parser.add_argument("-fast", "--fast-preprocess", default=False, action="store_true", help="Resize images with opencv instead of skimage.")
+    parser.add_argument("-interp", "--interpolation", default="auto", choices=["auto", "nearest", "linear", "cubic", "area"], help="Interpolation of the fast resize.")
+    parser.add_argument("-bf16", "--mixed-precision", default=False, action="store_true", help="Train with bfloat16 autocast on the CPU.")
+    parser.add_argument("-cl", "--channels-last", default=False, action="store_true", help="Train with the channels last memory format.")
+    parser.add_argument("-tol", "--accuracy-tolerance", default=0.01, type=float, help="Largest bfloat16 evaluation accuracy drop before training continues in float32.")
+    parser.add_argument("-np", "--processes", default=1, type=int, help="Amount of data parallel training processes on this host.")
+    parser.add_argument("-keep", "--keep-checkpoints", default=1, type=int, help="Amount of checkpoints to keep, the previous ones get a number suffix.")
+    parser.add_argument("-shards", "--shard-folder", type=str, default=None, help="Read the images from shards built with build_image_shards.py.")
+    parser.add_argument("-emb", "--embedding-folder", type=str, default=None,
+                        help="Cache the frozen backbone's embeddings in this folder and train the head on them instead of on images.")
     parser.add_argument("-l", "--label-index", required=True, type=int, help="Which index to use as the label, between 1 and 5. Use 1 o classify species, 5 to classify families.")
     return parser
 
@@ -37,6 +47,12 @@ if __name__ == '__main__':
     parser = get_argparser()
     args = parser.parse_args()
     training_indices = pd.read_csv(args.training_index_file, sep=' ', header=None)
-    training_butterfly_dataloader = get_butterfly_dataloader(args.image_root, args.training_index_file, args.species_file, args.batch_size, args.label_index)
-    development_butterfly_dataloader = get_butterfly_dataloader(args.image_root, args.development_index_file, args.species_file, args.batch_size, args.label_index)
-    run_transfer_learning(args.model_name, args.model_checkpoint, training_butterfly_dataloader, development_butterfly_dataloader, training_indices.iloc[:, args.label_index].nunique(), resume=args.resume, epochs=args.epochs)
+    training_butterfly_dataloader = get_butterfly_dataloader(args.image_root, args.training_index_file, args.species_file, args.batch_size, args.label_index,
+                                                             shard_folder=args.shard_folder,
+                                                             fast_preprocess=args.fast_preprocess, interpolation=args.interpolation)
+    development_butterfly_dataloader = get_butterfly_dataloader(args.image_root, args.development_index_file, args.species_file, args.batch_size, args.label_index,
+                                                                shard_folder=args.shard_folder,
+                                                                fast_preprocess=args.fast_preprocess, interpolation=args.interpolation)
+    run_transfer_learning(args.model_name, args.model_checkpoint, training_butterfly_dataloader, development_butterfly_dataloader, training_indices.iloc[:, args.label_index].nunique(), resume=args.resume, epochs=args.epochs,
+                          mixed_precision=args.mixed_precision, channels_last=args.channels_last, accuracy_tolerance=args.accuracy_tolerance,
+                          processes=args.processes, keep_checkpoints=args.keep_checkpoints, embedding_folder=args.embedding_folder)
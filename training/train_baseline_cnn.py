@@ -20,6 +20,8 @@ def get_argparser():
                         help="The path to the file with training indices")
     parser.add_argument("-test-idx", "--test-index-file", type=str, default="data/Butterfly200_test_release.txt",
                         help="The path to the file with test indices")
+    parser.add_argument("-dev-idx", "--development-index-file", type=str, default="data/Butterfly200_val_release.txt",
+                        help="The path to the file with development indices")
     parser.add_argument("-s", "--species-file", type=str, default="data/species.txt",
                         help="The path to the file with mappings from index to species name")
     parser.add_argument("-l", "--label-index", required=True, type=int, help="Which index to use as the label, between 1 and 5. Use 1 o classify species, 5 to classify families.")
@@ -29,6 +31,14 @@ def get_argparser():
     parser.add_argument("-check", "--model-checkpoint", type=str, default="data_pipeline/saved_models/baseline_cnn_checkpoint", help="Model checkpoint.")
     parser.add_argument("-color", "--color-space", type=str, default=None, help="Color space to use.")
     parser.add_argument("-g", "--grey", default=False, action="store_true", help="Use grey images in training.")
+    parser.add_argument("-fast", "--fast-preprocess", default=False, action="store_true", help="Resize images with opencv instead of skimage.")
+    parser.add_argument("-interp", "--interpolation", default="auto", choices=["auto", "nearest", "linear", "cubic", "area"], help="Interpolation of the fast resize.")
+    parser.add_argument("-bf16", "--mixed-precision", default=False, action="store_true", help="Train with bfloat16 autocast on the CPU.")
+    parser.add_argument("-cl", "--channels-last", default=False, action="store_true", help="Train with the channels last memory format.")
+    parser.add_argument("-tol", "--accuracy-tolerance", default=0.01, type=float, help="Largest bfloat16 evaluation accuracy drop before training continues in float32.")
+    parser.add_argument("-np", "--processes", default=1, type=int, help="Amount of data parallel training processes on this host.")
+    parser.add_argument("-keep", "--keep-checkpoints", default=1, type=int, help="Amount of checkpoints to keep, the previous ones get a number suffix.")
+    parser.add_argument("-shards", "--shard-folder", type=str, default=None, help="Read the images from shards built with build_image_shards.py.")
     return parser
 
 if __name__ == '__main__':
@@ -37,10 +47,20 @@ if __name__ == '__main__':
     training_indices = pd.read_csv(args.training_index_file, sep=' ', header=None)
     training_butterfly_dataloader = get_butterfly_dataloader(args.image_root, args.training_index_file, args.species_file,\
                                                                 batch_size=args.batch_size, label_i=args.label_index,\
-                                                                    color_space=args.color_space, grey=args.grey)
+                                                                    color_space=args.color_space, grey=args.grey, shard_folder=args.shard_folder,
+                                                                fast_preprocess=args.fast_preprocess, interpolation=args.interpolation)
     development_butterfly_dataloader = get_butterfly_dataloader(args.image_root, args.development_index_file, args.species_file,\
                                                                     batch_size=args.batch_size, label_i=args.label_index,\
-                                                                        color_space=args.color_space, grey=args.grey)
+                                                                        color_space=args.color_space, grey=args.grey, shard_folder=args.shard_folder,
+                                                                fast_preprocess=args.fast_preprocess, interpolation=args.interpolation)
     baseline_cnn = BaselineCNN(grey=args.grey)
-    run_baseline_training(baseline_cnn, args.model_checkpoint + '_' args.colour_space, training_butterfly_dataloader,\
-                                development_butterfly_dataloader, resume=args.resume, epochs=args.epochs)
+    # BaselineCNNDataset looks for the extractor of a colour space or grey under these names
+    model_checkpoint = args.model_checkpoint
+    if args.color_space is not None:
+        model_checkpoint += '_' + args.color_space
+    elif args.grey:
+        model_checkpoint += '_grey'
+    run_baseline_training(baseline_cnn, model_checkpoint, training_butterfly_dataloader,\
+                                development_butterfly_dataloader, resume=args.resume, epochs=args.epochs,
+                                mixed_precision=args.mixed_precision, channels_last=args.channels_last, accuracy_tolerance=args.accuracy_tolerance,
+                                processes=args.processes, keep_checkpoints=args.keep_checkpoints)